@@ -6,63 +6,577 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import argparse
+import array
+import collections
+import contextlib
+import functools
 import json
+import math
 import os
 import platform
 import psutil
+import random
 import signal
 import sys
 import threading
 import time
 import traceback
+import uuid
 
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from awscrt import io, mqtt
 from awsiot import iotshadow, mqtt_connection_builder
 
 # GLOBALS
 AWS_CONNECT_ATTEMPTS = 5
-AWS_CONNECT_DELAY_SECS = 10
+# Connect retries back off exponentially from AWS_CONNECT_DELAY_SECS up to
+# AWS_CONNECT_MAX_DELAY_SECS, with jitter
+AWS_CONNECT_DELAY_SECS = 1
+AWS_CONNECT_MAX_DELAY_SECS = 30
 AWS_KEEP_ALIVE_SECS = 15
 AWS_PUBLISH_DELAY_SECS = 5
+# Publish the full reported state at least this often, otherwise only the
+# fields that changed beyond SHADOW_THRESHOLDS
+AWS_SHADOW_HEARTBEAT_SECS = 300
+# Sample the metrics this often in the background; each shadow update
+# reports min/avg/max/p95 of the samples taken since the previous one
+AWS_SAMPLE_SECS = 1
+# Samples kept per metric between updates, older ones are overwritten
+AWS_SAMPLE_BUFFER = 300
+# While disconnected the reported states are buffered, up to
+# AWS_OFFLINE_SAMPLES in memory plus AWS_SPILL_MAX_BYTES in the optional
+# spill file, and sent in batches of AWS_TELEMETRY_BATCH samples on the
+# telemetry topic once the connection is back. A batch is also kept under
+# AWS_TELEMETRY_MAX_BYTES (AWS IoT rejects messages over 128 KB); batches
+# that fail are sent again up to AWS_TELEMETRY_RETRIES times
+AWS_OFFLINE_SAMPLES = 720
+AWS_SPILL_MAX_BYTES = 10 * 1024 * 1024
+AWS_TELEMETRY_BATCH = 50
+AWS_TELEMETRY_MAX_BYTES = 120 * 1024
+AWS_TELEMETRY_RETRIES = 3
+# Log the pipeline stats this often; updates not accepted within
+# AWS_UPDATE_TIMEOUT_SECS are counted as lost
+AWS_STATS_SECS = 60
+AWS_UPDATE_TIMEOUT_SECS = 60
+# AWS IoT rejects shadow states over 8 KB; larger updates are sent without
+# the per-device metrics of SHADOW_DETAIL, only their totals
+AWS_SHADOW_MAX_BYTES = 8 * 1024
+SHADOW_DETAIL = ("network", "disk", "containers")
+
+# Minimum change of a reported metric before it is sent again, keyed by
+# dotted path; the closest listed parent applies, e.g. "network" covers
+# "network.eth0.up.avg", and unlisted metrics are sent on any change
+SHADOW_THRESHOLDS = {
+    "cpu": 5.0,
+    "mem": 2.0,
+    "network": 5.0,
+    "disk": 10.0,
+    "load": 0.2,
+    "temperature": 1.0,
+    "containers": 5.0,
+}
+
+
+class Stats(object):
+    """Counters and timers for the sampling and publish pipeline."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+        # name -> (count, total secs, max secs)
+        self.timers = {}
+        # client token -> publish time of shadow updates awaiting a response
+        self.in_flight = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, secs):
+        with self.lock:
+            count, total, peak = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (count + 1, total + secs, max(peak, secs))
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def update_sent(self, token):
+        with self.lock:
+            self.in_flight[token] = time.time()
+
+    def update_done(self, token, outcome):
+        """Record the response to a shadow update as a shadow.<outcome>
+        timer, measured from the publish."""
+        with self.lock:
+            sent = self.in_flight.pop(token, None)
+        if sent is not None:
+            self.observe("shadow.%s" % (outcome), time.time() - sent)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            for token, sent in list(self.in_flight.items()):
+                if now - sent > AWS_UPDATE_TIMEOUT_SECS:
+                    del self.in_flight[token]
+                    self.counters["shadow.lost"] += 1
+            return {
+                "uptime": round(now - self.started),
+                "in_flight": len(self.in_flight),
+                "counters": dict(self.counters),
+                "timers": dict(
+                    (name, {
+                        "count": count,
+                        "avg_ms": round(total * 1000 / count, 1),
+                        "max_ms": round(peak * 1000, 1),
+                    }) for name, (count, total, peak) in self.timers.items()),
+            }
+
+
+stats = Stats()
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(stats.snapshot()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_stats(port):
+    server = HTTPServer(("127.0.0.1", port), StatsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="stats")
+    thread.daemon = True
+    thread.start()
+    print("[stats] Serving on http://127.0.0.1:%d/" % (port))
+
+
+class RingBuffer(object):
+    """Fixed-size buffer of the most recent samples."""
+    def __init__(self, size):
+        self.data = array.array('d', [0.0] * size)
+        self.size = size
+        self.index = 0
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def drain(self):
+        start = self.index - self.count
+        values = [self.data[(start + i) % self.size]
+                  for i in range(self.count)]
+        self.count = 0
+        return values
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "min": round(values[0], 2),
+        "avg": round(sum(values) / len(values), 2),
+        "max": round(values[-1], 2),
+        "p95": round(values[int(math.ceil(0.95 * len(values))) - 1], 2),
+    }
+
+
+def metric_name(name):
+    # dots separate the levels of a metric path
+    return name.replace(".", "_")
+
+
+class Collector(object):
+    """Base class for metric collectors.
+
+    collect() returns a dict of dotted metric paths to numbers. It runs
+    every interval seconds (every sample when None) and declares its cost
+    as the seconds a run may take: results that arrive later are dropped,
+    so a slow collector cannot hold up the others or a shadow update.
+    """
+    interval = None
+    cost = 0.5
+
+    def __init__(self):
+        self.name = self.__class__.__name__
+
+    def collect(self):
+        raise NotImplementedError()
+
+
+class RateCollector(Collector):
+    """Helper for collectors reporting counters as KB/s rates."""
+    def __init__(self):
+        super(RateCollector, self).__init__()
+        self.before_ts = None
+        self.before = {}
+
+    def rates(self, counters):
+        now = time.time()
+        rates = {}
+        if self.before_ts is not None:
+            duration = (now - self.before_ts) * 1024
+            for path, value in counters.items():
+                if path in self.before and duration > 0:
+                    rates[path] = (value - self.before[path]) / duration
+        self.before_ts = now
+        self.before = counters
+        return rates
+
+
+class SystemCollector(Collector):
+    def __init__(self):
+        super(SystemCollector, self).__init__()
+        psutil.cpu_percent(percpu=False)
+
+    def collect(self):
+        return {
+            "cpu": psutil.cpu_percent(percpu=False),
+            "mem": psutil.virtual_memory().percent,
+        }
 
 
-class LockedData(object):
-    def __init__(self, thing_name=platform.node()):
+class NetworkCollector(RateCollector):
+    """Total traffic and that of the max_interfaces busiest interfaces.
+
+    Loopback and the virtual interfaces of containers and bridges are
+    excluded.
+    """
+    exclude = ("lo", "veth", "docker", "br-", "virbr", "ifb")
+    max_interfaces = 8
+
+    def collect(self):
+        counters = {"network.up": 0, "network.down": 0}
+        nics = [(nic, nic_io) for nic, nic_io
+                in psutil.net_io_counters(pernic=True).items()
+                if not nic.startswith(self.exclude)]
+        for nic, nic_io in nics:
+            counters["network.up"] += nic_io.bytes_sent
+            counters["network.down"] += nic_io.bytes_recv
+        nics.sort(key=lambda n: n[1].bytes_sent + n[1].bytes_recv,
+                  reverse=True)
+        for nic, nic_io in nics[:self.max_interfaces]:
+            counters["network.%s.up" % metric_name(nic)] = nic_io.bytes_sent
+            counters["network.%s.down" % metric_name(nic)] = nic_io.bytes_recv
+        return self.rates(counters)
+
+
+class DiskCollector(RateCollector):
+    """Total and per-disk throughput, loop and ram devices excluded."""
+    def collect(self):
+        total = psutil.disk_io_counters()
+        counters = {"disk.read": total.read_bytes,
+                    "disk.write": total.write_bytes}
+        for disk, disk_io in psutil.disk_io_counters(perdisk=True).items():
+            if disk.startswith(("loop", "ram")):
+                continue
+            counters["disk.%s.read" % metric_name(disk)] = disk_io.read_bytes
+            counters["disk.%s.write" % metric_name(disk)] = disk_io.write_bytes
+        return self.rates(counters)
+
+
+class LoadCollector(Collector):
+    interval = 5
+
+    def collect(self):
+        load1, load5, load15 = os.getloadavg()
+        return {"load.1": load1, "load.5": load5, "load.15": load15}
+
+
+class TemperatureCollector(Collector):
+    interval = 10
+
+    def collect(self):
+        temps = {}
+        if not hasattr(psutil, "sensors_temperatures"):
+            return temps
+        for sensor, entries in psutil.sensors_temperatures().items():
+            for i, entry in enumerate(entries):
+                label = metric_name(entry.label or str(i))
+                temps["temperature.%s.%s" % (metric_name(sensor), label)] = \
+                    entry.current
+        return temps
+
+
+class ContainerCollector(Collector):
+    """CPU % and memory (MB) of the max_containers containers using the
+    most memory, found by scanning processes.
+
+    Only sees other containers when running in the host PID namespace.
+    """
+    interval = 30
+    cost = 5
+    max_containers = 10
+
+    def __init__(self):
+        super(ContainerCollector, self).__init__()
+        self.before_ts = None
+        self.before = {}
+
+    @staticmethod
+    def container_id(pid):
+        try:
+            with open("/proc/%d/cgroup" % pid) as f:
+                for line in f:
+                    path = line.rstrip().split(":", 2)[-1]
+                    if "/docker/" in path:
+                        return path.rsplit("/", 1)[-1][:12]
+                    if path.startswith("/system.slice/docker-"):
+                        return path[len("/system.slice/docker-"):][:12]
+        except (IOError, OSError):
+            pass
+        return None
+
+    def collect(self):
+        now = time.time()
+        cpu = {}
+        mem = {}
+        for proc in psutil.process_iter():
+            container = self.container_id(proc.pid)
+            if container is None:
+                continue
+            try:
+                times = proc.cpu_times()
+                rss = proc.memory_info().rss
+            except psutil.Error:
+                continue
+            cpu[container] = cpu.get(container, 0) + times.user + times.system
+            mem[container] = mem.get(container, 0) + rss
+        stats = {}
+        top = sorted(mem, key=mem.get, reverse=True)[:self.max_containers]
+        for container in top:
+            used = cpu[container]
+            stats["containers.%s.mem" % container] = \
+                round(mem[container] / (1024 * 1024), 2)
+            if self.before_ts is not None and container in self.before:
+                stats["containers.%s.cpu" % container] = \
+                    100 * (used - self.before[container]) / \
+                    (now - self.before_ts)
+        self.before_ts = now
+        self.before = cpu
+        return stats
+
+
+COLLECTORS = [
+    SystemCollector,
+    NetworkCollector,
+    DiskCollector,
+    LoadCollector,
+    TemperatureCollector,
+    ContainerCollector,
+]
+
+
+class Sampler(threading.Thread):
+    """Run the collectors concurrently and keep their samples in ring
+    buffers."""
+    def __init__(self, collectors, interval=AWS_SAMPLE_SECS,
+                 size=AWS_SAMPLE_BUFFER):
+        super(Sampler, self).__init__(name="sampler")
+        self.daemon = True
+        self.collectors = collectors
+        self.interval = interval
+        self.size = size
         self.lock = threading.Lock()
+        self.buffers = {}
+        self.executor = ThreadPoolExecutor(max_workers=len(collectors))
+        # collector -> time of its last run, and the runs in progress
+        self.last_run = dict((c, 0) for c in collectors)
+        self.running = set()
+
+    def record(self, collector, started, future):
+        self.running.discard(collector)
+        try:
+            values = future.result()
+        except Exception as e:
+            print("[sampler] %s failed: %s" % (collector.name, e))
+            stats.inc("collect.failed")
+            return
+        elapsed = time.time() - started
+        stats.observe("collect.%s" % (collector.name), elapsed)
+        if elapsed > collector.cost:
+            stats.inc("collect.dropped")
+            print("[sampler] %s took %.2fs (budget %.2fs), dropping"
+                  % (collector.name, elapsed, collector.cost))
+            return
+        with self.lock:
+            for metric, value in values.items():
+                if metric not in self.buffers:
+                    self.buffers[metric] = RingBuffer(self.size)
+                self.buffers[metric].append(value)
+
+    def sample(self):
+        now = time.time()
+        for collector in self.collectors:
+            interval = collector.interval or self.interval
+            if collector in self.running or \
+                    now - self.last_run[collector] < interval:
+                continue
+            self.last_run[collector] = now
+            self.running.add(collector)
+            future = self.executor.submit(collector.collect)
+            future.add_done_callback(
+                lambda f, c=collector, t=now: self.record(c, t, f))
+
+    def run(self):
+        deadline = time.time()
+        while True:
+            self.sample()
+            deadline += self.interval
+            time.sleep(max(0, deadline - time.time()))
+
+    def summary(self):
+        """Return the summaries of the samples taken since the last call
+        nested by metric path, e.g. {"network": {"up": {"avg": ...}}}."""
+        with self.lock:
+            samples = dict((m, b.drain()) for m, b in self.buffers.items())
+        data = {}
+        for metric, values in sorted(samples.items()):
+            stats = summarize(values)
+            if stats is None:
+                continue
+            node = data
+            path = metric.split(".")
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = stats
+        return data
+
+
+class TelemetryBuffer(object):
+    """Bounded buffer of (timestamp, state) samples taken while offline.
+
+    Samples that do not fit in memory are appended to the spill file, if
+    one is given, instead of being dropped. The spill file survives a
+    restart and is sent with the next batch. Batches that failed to
+    publish are kept apart, with their attempt count, and sent again first.
+    """
+    def __init__(self, size=AWS_OFFLINE_SAMPLES, spill=None,
+                 max_bytes=AWS_SPILL_MAX_BYTES):
+        self.lock = threading.Lock()
+        self.size = size
+        self.spill = spill
+        self.max_bytes = max_bytes
+        self.samples = collections.deque()
+        self.failed = []
+        self.dropped = 0
+
+    def pending(self):
+        with self.lock:
+            return bool(self.samples) or bool(self.failed) or bool(
+                self.spill and os.path.exists(self.spill))
+
+    def requeue(self, batch, attempts):
+        """Keep a failed batch to be sent again, returns False if it has
+        been tried AWS_TELEMETRY_RETRIES times and is dropped instead."""
+        if attempts >= AWS_TELEMETRY_RETRIES:
+            return False
+        with self.lock:
+            self.failed.append((attempts, batch))
+        return True
+
+    def retries(self):
+        """Remove and return the failed (attempts, batch) pairs, oldest
+        first. They are older than any sample still buffered."""
+        with self.lock:
+            failed = sorted(self.failed, key=lambda f: f[1][0][0])
+            del self.failed[:]
+        return failed
+
+    def add(self, ts, state):
+        with self.lock:
+            self.samples.append((ts, state))
+            if len(self.samples) > self.size:
+                if not self.spill_sample(self.samples.popleft()):
+                    self.dropped += 1
+
+    def spill_sample(self, sample):
+        if not self.spill:
+            return False
+        line = json.dumps(sample, separators=(",", ":")) + "\n"
+        try:
+            if os.path.exists(self.spill) and \
+                    os.path.getsize(self.spill) + len(line) > self.max_bytes:
+                return False
+            with open(self.spill, "a") as f:
+                f.write(line)
+        except (IOError, OSError) as e:
+            print("[buffer] Unable to spill sample: %s" % (e))
+            return False
+        return True
+
+    def drain(self):
+        """Remove and return all samples, oldest first."""
+        samples = []
+        with self.lock:
+            if self.spill and os.path.exists(self.spill):
+                try:
+                    with open(self.spill) as f:
+                        for line in f:
+                            try:
+                                samples.append(tuple(json.loads(line)))
+                            except ValueError:
+                                pass
+                    os.unlink(self.spill)
+                except (IOError, OSError) as e:
+                    print("[buffer] Unable to read spill file: %s" % (e))
+            samples.extend(self.samples)
+            self.samples.clear()
+            if self.dropped:
+                print("[buffer] Dropped %d samples" % (self.dropped))
+                self.dropped = 0
+        return samples
+
+
+class LockedData(object):
+    """Connection and shadow state of one thing."""
+    def __init__(self, thing_name=platform.node(), provision_location=None):
+        # reentrant: the signal handler disconnects on the main thread,
+        # which may already be disconnecting the thing
+        self.lock = threading.RLock()
         self.thing_name = thing_name
-        self.before_ts = 0
-        self.ioBefore = None
-        self.diskBefore = None
+        self.provision_location = provision_location
+        self.connection = None
+        self.shadow_client = None
+        self.telemetry = None
+        self.telemetry_topic = None
+        self.publish_count = 1
         self.disconnect_called = False
-
-    def toJSON(self):
-        after_ts = time.time()
-        ioAfter = psutil.net_io_counters()
-        diskAfter = psutil.disk_io_counters()
-        # Calculate the time taken between IO checks
-        duration = after_ts - self.before_ts
-        data = {
-            "name": self.thing_name,
-            "cpu": psutil.cpu_percent(percpu=False),
-            "mem": psutil.virtual_memory().percent,
-            "network": {
-                "up": round((ioAfter.bytes_sent - self.ioBefore.bytes_sent) / (duration * 1024), 2),
-                "down": round((ioAfter.bytes_recv - self.ioBefore.bytes_recv) / (duration * 1024), 2),
-            },
-            "disk": {
-                "read": round((diskAfter.read_bytes - self.diskBefore.read_bytes) / (duration * 1024), 2),
-                "write": round((diskAfter.write_bytes - self.diskBefore.write_bytes) / (duration * 1024), 2),
-            },
-        }
-        self.before_ts = after_ts
-        self.ioBefore = ioAfter
-        self.diskBefore = diskAfter
+        self.connected = False
+        self.interrupted_ts = 0
+        # failure reported by an event-loop callback, an exception or a
+        # message; the main loop stops serving the thing
+        self.error = None
+        # last reported state accepted by AWS and when it was last sent
+        # in full, guarded by state_lock rather than lock so a shutdown
+        # never waits on the shadow bookkeeping
+        self.state_lock = threading.Lock()
+        self.reported = {}
+        self.full_ts = 0
+
+    def toJSON(self, summary):
+        data = {"name": self.thing_name}
+        data.update(summary)
         return data
 
 
-locked_data = LockedData()
+# LockedData of every thing served by this process
+things = []
 
 
 ###############################################################################
@@ -71,24 +585,167 @@ locked_data = LockedData()
 #
 ###############################################################################
 
-def cleanup(msg_or_exception):
-    global aws_mqtt
+def merge_state(state, update):
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(state.get(key), dict):
+            merge_state(state[key], value)
+        else:
+            state[key] = value
+
+
+def threshold(thresholds, path):
+    while path:
+        if path in thresholds:
+            return thresholds[path]
+        path = path.rpartition(".")[0]
+    return 0
+
+
+def shadow_delta(reported, data, thresholds, prefix=""):
+    """Return the parts of data that differ from the reported state by more
+    than their threshold."""
+    delta = {}
+    for key, value in data.items():
+        path = prefix + key
+        old = reported.get(key)
+        if isinstance(value, dict):
+            changed = shadow_delta(old if isinstance(old, dict) else {},
+                                   value, thresholds, path + ".")
+            if changed:
+                delta[key] = changed
+        elif isinstance(value, (int, float)) and \
+                isinstance(old, (int, float)):
+            if abs(value - old) > threshold(thresholds, path):
+                delta[key] = value
+        elif value != old:
+            delta[key] = value
+    return delta
+
+
+def trim_state(reported):
+    """Return reported without the per-device metrics of SHADOW_DETAIL."""
+    trimmed = dict(reported)
+    for key in SHADOW_DETAIL:
+        if not isinstance(reported.get(key), dict):
+            continue
+        group = dict((name, value) for name, value in reported[key].items()
+                     if not (isinstance(value, dict) and any(
+                         isinstance(v, dict) for v in value.values())))
+        if group:
+            trimmed[key] = group
+        else:
+            del trimmed[key]
+    return trimmed
+
+
+def backoff(attempt):
+    """Seconds to wait after failed attempt number attempt."""
+    delay = min(AWS_CONNECT_MAX_DELAY_SECS,
+                AWS_CONNECT_DELAY_SECS * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def gateway_things(location):
+    """Return (thing name, provisioning folder) for every thing provisioned
+    below location: a folder holding device.crt and device.key, and the
+    thing's name in a thing_name file or as the folder name."""
+    found = []
+    for entry in sorted(os.listdir(location)):
+        folder = os.path.join(location, entry)
+        if not (os.path.isfile(os.path.join(folder, "device.crt")) and
+                os.path.isfile(os.path.join(folder, "device.key"))):
+            continue
+        name = entry
+        try:
+            with open(os.path.join(folder, "thing_name")) as f:
+                name = f.read().strip() or entry
+        except (IOError, OSError):
+            pass
+        found.append((name, folder))
+    return found
+
+
+def telemetry_payload(thing, batch):
+    return json.dumps({"name": thing.thing_name, "samples": batch},
+                      separators=(",", ":"))
+
+
+def telemetry_batches(thing, samples):
+    """Split samples into batches of at most AWS_TELEMETRY_BATCH samples
+    whose payload stays under AWS_TELEMETRY_MAX_BYTES."""
+    overhead = len(telemetry_payload(thing, []))
+    batch, size = [], overhead
+    for sample in samples:
+        # encoded length plus the separating comma
+        length = len(json.dumps(sample, separators=(",", ":"))) + 1
+        if overhead + length > AWS_TELEMETRY_MAX_BYTES:
+            print("[aws] [%s] Dropping a %d byte sample, too large to publish"
+                  % (thing.thing_name, length))
+            stats.inc("telemetry.dropped")
+            continue
+        if batch and (len(batch) >= AWS_TELEMETRY_BATCH or
+                      size + length > AWS_TELEMETRY_MAX_BYTES):
+            yield batch
+            batch, size = [], overhead
+        batch.append(sample)
+        size += length
+    if batch:
+        yield batch
+
+
+def publish_telemetry_batch(thing, batch, attempts):
+    future, _ = thing.connection.publish(thing.telemetry_topic,
+                                         telemetry_payload(thing, batch),
+                                         mqtt.QoS.AT_LEAST_ONCE)
+    future.add_done_callback(
+        lambda f: on_publish_telemetry(f, thing, batch, attempts + 1))
+
+
+def publish_telemetry(thing):
+    """Send the buffered samples as batches of [timestamp, state] pairs,
+    batches that failed before go first."""
+    for attempts, batch in thing.telemetry.retries():
+        publish_telemetry_batch(thing, batch, attempts)
+    sent = 0
+    for batch in telemetry_batches(thing, thing.telemetry.drain()):
+        publish_telemetry_batch(thing, batch, 0)
+        sent += len(batch)
+    stats.inc("telemetry.sent", sent)
+    if sent:
+        print("[aws] [%s] Sent %d buffered samples to %s"
+              % (thing.thing_name, sent, thing.telemetry_topic))
+
 
+def cleanup(msg_or_exception):
     if isinstance(msg_or_exception, Exception):
         print("[cleanup] Exiting sample due to exception.")
         traceback.print_exception(msg_or_exception.__class__, msg_or_exception, sys.exc_info()[2])
     elif msg_or_exception is not None:
         print("[cleanup] Exit msg: %s" % (msg_or_exception))
 
-    with locked_data.lock:
-        if not locked_data.disconnect_called:
-            print("[cleanup] Disconnecting...")
-            locked_data.disconnect_called = True
+    for thing in things:
+        disconnect(thing)
+
+    sys.exit(0)
+
+
+def disconnect(thing):
+    with thing.lock:
+        if not thing.disconnect_called and thing.connection:
+            print("[cleanup] Disconnecting %s..." % (thing.thing_name))
+            thing.disconnect_called = True
             # disconnect from AWS
-            disconnect_future = aws_mqtt.disconnect()
+            disconnect_future = thing.connection.disconnect()
             disconnect_future.result()
 
-    sys.exit(0)
+
+def drop_thing(thing, msg_or_exception):
+    """Stop serving a failed thing, exit once no thing is left."""
+    print("[aws] [%s] Dropping thing: %s" % (thing.thing_name, msg_or_exception))
+    things.remove(thing)
+    disconnect(thing)
+    if not things:
+        cleanup(msg_or_exception)
 
 
 def signal_handler(sig, frame):
@@ -103,15 +760,23 @@ def signal_handler(sig, frame):
 ###############################################################################
 
 # Callback when connection is accidentally lost.
-def aws_on_connection_interrupted(connection, error, **kwargs):
-    print("[aws] Connection interrupted. error: {}".format(error))
+def aws_on_connection_interrupted(thing, connection, error, **kwargs):
+    print("[aws] [%s] Connection interrupted. error: %s"
+          % (thing.thing_name, error))
+    thing.connected = False
+    thing.interrupted_ts = time.time()
+    stats.inc("connection.interrupted")
 
 
 # Callback when an interrupted connection is re-established.
-def aws_on_connection_resumed(connection, return_code, session_present,
+def aws_on_connection_resumed(thing, connection, return_code, session_present,
                               **kwargs):
-    print("[aws] Connection resumed. return_code: %s session_present: %s"
-          % (return_code, session_present))
+    print("[aws] [%s] Connection resumed. return_code: %s session_present: %s"
+          % (thing.thing_name, return_code, session_present))
+    thing.connected = return_code == mqtt.ConnectReturnCode.ACCEPTED
+    if thing.connected and thing.interrupted_ts:
+        stats.observe("connection.outage", time.time() - thing.interrupted_ts)
+        thing.interrupted_ts = 0
 
     if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
         print("[aws] Session did not persist. Resubscribing to topics...")
@@ -133,191 +798,349 @@ def aws_on_resubscribe_complete(resubscribe_future):
                      % (topic))
 
 
-def on_shadow_delta_updated(delta):
-    # type: (iotshadow.ShadowDeltaUpdatedEvent) -> None
+def on_shadow_delta_updated(thing, delta):
+    # type: (LockedData, iotshadow.ShadowDeltaUpdatedEvent) -> None
     try:
         if delta.state:
-            print("[aws] Delta reported a shadow data change")
+            print("[aws] [%s] Delta reported a shadow data change"
+                  % (thing.thing_name))
         else:
-            print("[aws] Delta did not report a change")
+            print("[aws] [%s] Delta did not report a change"
+                  % (thing.thing_name))
     except Exception as e:
         exit(e)
 
 
-def on_update_shadow_accepted(response):
-    # type: (iotshadow.UpdateShadowResponse) -> None
-    print("[aws] Reported shadow values: %s" % (json.dumps(response.state.reported)))
+def on_update_shadow_accepted(thing, response):
+    # type: (LockedData, iotshadow.UpdateShadowResponse) -> None
+    print("[aws] [%s] Reported shadow values: %s"
+          % (thing.thing_name, json.dumps(response.state.reported)))
+    stats.update_done(response.client_token, "accepted")
+    if response.state and response.state.reported:
+        with thing.state_lock:
+            merge_state(thing.reported, response.state.reported)
 
 
-def on_update_shadow_rejected(error):
-    # type: (iotshadow.ErrorResponse) -> None
-    cleanup("[aws] Update request was rejected. code:{} message:'{}'".format(
-        error.code, error.message))
+def on_update_shadow_rejected(thing, error):
+    # type: (LockedData, iotshadow.ErrorResponse) -> None
+    stats.update_done(error.client_token, "rejected")
+    msg = "[aws] [{}] Update request was rejected. code:{} message:'{}'".format(
+        thing.thing_name, error.code, error.message)
+    if error.code in (401, 403):
+        thing.error = msg
+    else:
+        # e.g. 413 for a document too large; the fields are sent again
+        # with the next delta as they never made it into thing.reported
+        print(msg)
 
 
-def on_get_shadow_accepted(response):
-    # type: (iotshadow.GetShadowResponse) -> None
-    print("[aws] Finished getting initial shadow state.")
+def on_get_shadow_accepted(thing, response):
+    # type: (LockedData, iotshadow.GetShadowResponse) -> None
+    print("[aws] [%s] Finished getting initial shadow state."
+          % (thing.thing_name))
+    if response.state and response.state.reported:
+        with thing.state_lock:
+            merge_state(thing.reported, response.state.reported)
 
 
-def on_get_shadow_rejected(error):
-    # type: (iotshadow.ErrorResponse) -> None
+def on_get_shadow_rejected(thing, error):
+    # type: (LockedData, iotshadow.ErrorResponse) -> None
     if error.code == 404:
-        print("[aws] Thing has no shadow document.")
+        print("[aws] [%s] Thing has no shadow document." % (thing.thing_name))
     else:
-        cleanup("[aws] Get request was rejected. code:{} message:'{}'".format(
-            error.code, error.message))
+        thing.error = "[aws] [{}] Get request was rejected. code:{} message:'{}'".format(
+            thing.thing_name, error.code, error.message)
 
 
-def on_publish_update_shadow(future):
-    # type: (Future) -> None
+def on_startup_request_done(thing, future):
+    # type: (LockedData, Future) -> None
+    # Runs on the event-loop thread, which must not block or exit; the main
+    # loop acts on the error.
     try:
         future.result()
-        print("[aws] Update request published.")
     except Exception as e:
-        print("[aws] Failed to publish update request.")
-        exit(e)
+        print("[aws] [%s] Startup request failed: %s" % (thing.thing_name, e))
+        thing.error = e
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="AWS IoT Client")
-    parser.add_argument("-t", "--thing-name", help='AWS Thing Name',
-                        required=True)
-    parser.add_argument("-e", "--endpoint", help='AWS ATS Endpoint',
-                        default="ats.iot.us-east-1.amazonaws.com")
-    parser.add_argument("-p", "--provision-location",
-                        help='Device provisioning folder', default="/prov")
-    parser.add_argument("-c", "--cert-location", help='Certificates folder',
-                        default="/certs")
-    args = parser.parse_args()
+def on_publish_update_shadow(future, token):
+    # type: (Future, str) -> None
+    try:
+        future.result()
+        print("[aws] Update request published.")
+    except Exception as e:
+        stats.update_done(token, "failed")
+        # the state is sent again with the next update as it was never
+        # accepted
+        print("[aws] Failed to publish update request: %s" % (e))
 
-    # setup interrupt signals
-    # signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGQUIT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
 
-    # setup AWS connection
-    event_loop_group = io.EventLoopGroup(1)
-    host_resolver = io.DefaultHostResolver(event_loop_group)
-    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+def on_publish_telemetry(future, thing, batch, attempts):
+    # type: (Future, LockedData, list, int) -> None
+    try:
+        future.result()
+    except Exception as e:
+        stats.inc("telemetry.failed", len(batch))
+        if thing.telemetry.requeue(batch, attempts):
+            print("[aws] [%s] Failed to publish telemetry, buffering again: %s"
+                  % (thing.thing_name, e))
+        else:
+            print("[aws] [%s] Failed to publish telemetry %d times, "
+                  "dropping %d samples: %s"
+                  % (thing.thing_name, attempts, len(batch), e))
+            stats.inc("telemetry.dropped", len(batch))
 
+
+def connect_thing(thing, args, client_bootstrap):
+    """Connect thing and subscribe to its shadow topics, returns False if
+    all connection attempts failed."""
     # need a unique client id
-    aws_mqtt = mqtt_connection_builder.mtls_from_path(
+    thing.connection = mqtt_connection_builder.mtls_from_path(
         endpoint=args.endpoint,
-        cert_filepath="%s/device.crt" % (args.provision_location),
-        pri_key_filepath="%s/device.key" % (args.provision_location),
+        cert_filepath="%s/device.crt" % (thing.provision_location),
+        pri_key_filepath="%s/device.key" % (thing.provision_location),
         client_bootstrap=client_bootstrap,
         ca_filepath="%s/AmazonRootCA1.pem" % (args.cert_location),
-        on_connection_interrupted=aws_on_connection_interrupted,
-        on_connection_resumed=aws_on_connection_resumed,
-        client_id=args.thing_name,
+        on_connection_interrupted=functools.partial(
+            aws_on_connection_interrupted, thing),
+        on_connection_resumed=functools.partial(
+            aws_on_connection_resumed, thing),
+        client_id=thing.thing_name,
         clean_session=False,
         keep_alive_secs=AWS_KEEP_ALIVE_SECS)
 
     # connect loop
     conn_attempt = 1
-    connected = False
-    while not connected and conn_attempt <= AWS_CONNECT_ATTEMPTS:
+    session_present = False
+    connect_start = time.time()
+    while True:
         try:
             print("[aws] [%d] Connecting to %s as %s ..."
-                  % (conn_attempt, args.endpoint, args.thing_name))
-            connect_future = aws_mqtt.connect()
-            connect_future.result()
-            connected = True
+                  % (conn_attempt, args.endpoint, thing.thing_name))
+            connect_future = thing.connection.connect()
+            result = connect_future.result()
+            session_present = bool(result and result.get("session_present"))
+            break
         except:
             print("[aws] Failed connection: %s" % (sys.exc_info()[0]))
-        time.sleep(AWS_CONNECT_DELAY_SECS)
+        if conn_attempt >= AWS_CONNECT_ATTEMPTS:
+            return False
+        time.sleep(backoff(conn_attempt))
         conn_attempt += 1
-    if not connected:
-        print("[aws] Failed all connection attempts. Restarting.")
-        sys.exit(-1)
 
-    print("[aws] Connected!")
+    print("[aws] [%s] Connected! session_present: %s"
+          % (thing.thing_name, session_present))
+    stats.observe("connect", time.time() - connect_start)
+    thing.connected = True
 
     # create shadow client
-    shadow_client = iotshadow.IotShadowClient(aws_mqtt)
-
-    try:
-
-        # subscribe to delta updates
-        print("[aws] Subscribing to DELTA updates")
-
-        delta_subscribed_future, _ = shadow_client.subscribe_to_shadow_delta_updated_events(
-            request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(args.thing_name),
+    shadow_client = iotshadow.IotShadowClient(thing.connection)
+    thing.shadow_client = shadow_client
+
+    # Issue all subscriptions at once. The calls register the callbacks
+    # locally; when the persistent session is still present the broker
+    # already has the subscriptions, so don't wait for them.
+    print("[aws] [%s] Subscribing to DELTA, UPDATE and GET topics"
+          % (thing.thing_name))
+    subscribe_futures = [
+        shadow_client.subscribe_to_shadow_delta_updated_events(
+            request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(thing.thing_name),
             qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_shadow_delta_updated)
-
-        # Wait for subscription to succeed
-        delta_subscribed_future.result()
-
-        print("[aws] Subscribing to UPDATE responses")
-
-        update_accepted_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_accepted(
-            request=iotshadow.UpdateShadowSubscriptionRequest(args.thing_name),
+            callback=functools.partial(on_shadow_delta_updated, thing))[0],
+        shadow_client.subscribe_to_update_shadow_accepted(
+            request=iotshadow.UpdateShadowSubscriptionRequest(thing.thing_name),
             qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_update_shadow_accepted)
-
-        update_rejected_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_rejected(
-            request=iotshadow.UpdateShadowSubscriptionRequest(args.thing_name),
+            callback=functools.partial(on_update_shadow_accepted, thing))[0],
+        shadow_client.subscribe_to_update_shadow_rejected(
+            request=iotshadow.UpdateShadowSubscriptionRequest(thing.thing_name),
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=functools.partial(on_update_shadow_rejected, thing))[0],
+        shadow_client.subscribe_to_get_shadow_accepted(
+            request=iotshadow.GetShadowSubscriptionRequest(thing.thing_name),
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=functools.partial(on_get_shadow_accepted, thing))[0],
+        shadow_client.subscribe_to_get_shadow_rejected(
+            request=iotshadow.GetShadowSubscriptionRequest(thing.thing_name),
             qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_update_shadow_rejected)
+            callback=functools.partial(on_get_shadow_rejected, thing))[0],
+    ]
+    for future in subscribe_futures:
+        if session_present:
+            future.add_done_callback(
+                functools.partial(on_startup_request_done, thing))
+        else:
+            # Wait for subscriptions to succeed
+            future.result()
+
+    # The response will be received by the on_get_accepted() callback
+    print("[aws] [%s] Requesting current shadow state" % (thing.thing_name))
+    publish_get_future = shadow_client.publish_get_shadow(
+        request=iotshadow.GetShadowRequest(thing.thing_name),
+        qos=mqtt.QoS.AT_LEAST_ONCE)
+    publish_get_future.add_done_callback(
+        functools.partial(on_startup_request_done, thing))
+    return True
+
+
+def update_thing(thing, summary, now, args):
+    """Send the current state of thing to its shadow, or buffer it while
+    disconnected."""
+    data = thing.toJSON(summary)
+    if not thing.connected:
+        # the shadow only gets the latest state once we're back
+        thing.telemetry.add(now, data)
+        stats.inc("telemetry.buffered")
+        return
+    if thing.telemetry.pending():
+        publish_telemetry(thing)
+
+    with thing.state_lock:
+        if now - thing.full_ts >= args.heartbeat:
+            thing.full_ts = now
+            reported = data
+            if args.stats_shadow:
+                reported["stats"] = stats.snapshot()
+        else:
+            reported = shadow_delta(thing.reported, data, SHADOW_THRESHOLDS)
+    if not reported:
+        stats.inc("shadow.unchanged")
+        return
+    size = len(json.dumps(reported, separators=(",", ":")))
+    if size > AWS_SHADOW_MAX_BYTES:
+        print("[aws] [%s] Shadow update of %d bytes is too large, sending "
+              "totals only" % (thing.thing_name, size))
+        stats.inc("shadow.trimmed")
+        reported = trim_state(reported)
+
+    print("[aws] [%s] Updating shadow values [%d]"
+          % (thing.thing_name, thing.publish_count))
+    token = str(uuid.uuid4())
+    request = iotshadow.UpdateShadowRequest(
+        client_token=token,
+        thing_name=thing.thing_name,
+        state=iotshadow.ShadowState(
+            reported=reported,
+        )
+    )
+    stats.update_sent(token)
+    future = thing.shadow_client.publish_update_shadow(request, mqtt.QoS.AT_LEAST_ONCE)
+    future.add_done_callback(
+        lambda f: on_publish_update_shadow(f, token))
+    thing.publish_count += 1
+    stats.inc("shadow.published")
 
-        # Wait for subscriptions to succeed
-        update_accepted_subscribed_future.result()
-        update_rejected_subscribed_future.result()
 
-        print("[aws] Subscribing to GET responses")
-        get_accepted_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_accepted(
-            request=iotshadow.GetShadowSubscriptionRequest(args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_get_shadow_accepted)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="AWS IoT Client")
+    parser.add_argument("-t", "--thing-name", help='AWS Thing Name')
+    parser.add_argument("-g", "--gateway", action="store_true",
+                        help='Serve every thing provisioned in a sub-folder '
+                             'of the provisioning folder')
+    parser.add_argument("-e", "--endpoint", help='AWS ATS Endpoint',
+                        default="ats.iot.us-east-1.amazonaws.com")
+    parser.add_argument("-p", "--provision-location",
+                        help='Device provisioning folder', default="/prov")
+    parser.add_argument("-c", "--cert-location", help='Certificates folder',
+                        default="/certs")
+    parser.add_argument("--sample-secs", type=float,
+                        help='Seconds between metric samples',
+                        default=AWS_SAMPLE_SECS)
+    parser.add_argument("--telemetry-topic", default="telemetry/%s",
+                        help='Topic for samples buffered while offline, %%s '
+                             'is replaced by the thing name '
+                             '(default: telemetry/%%s)')
+    parser.add_argument("--spill-file",
+                        help='File to keep offline samples that do not fit '
+                             'in memory, suffixed by the thing name in '
+                             'gateway mode')
+    parser.add_argument("--stats-port", type=int,
+                        help='Serve pipeline stats as JSON on this local port')
+    parser.add_argument("--stats-shadow", action="store_true",
+                        help='Include pipeline stats in full shadow updates')
+    parser.add_argument("--heartbeat", type=int,
+                        help='Seconds between full shadow updates',
+                        default=AWS_SHADOW_HEARTBEAT_SECS)
+    args = parser.parse_args()
 
-        get_rejected_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_rejected(
-            request=iotshadow.GetShadowSubscriptionRequest(args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_get_shadow_rejected)
+    if args.gateway:
+        for name, folder in gateway_things(args.provision_location):
+            thing = LockedData(name, folder)
+            if args.spill_file:
+                spill = "%s.%s" % (args.spill_file, name)
+            else:
+                spill = None
+            thing.telemetry = TelemetryBuffer(spill=spill)
+            things.append(thing)
+        if not things:
+            sys.exit("[aws] No things provisioned in %s"
+                     % (args.provision_location))
+    elif args.thing_name:
+        thing = LockedData(args.thing_name, args.provision_location)
+        thing.telemetry = TelemetryBuffer(spill=args.spill_file)
+        things.append(thing)
+    else:
+        parser.error("--thing-name is required unless --gateway is used")
+    for thing in things:
+        if "%s" in args.telemetry_topic:
+            thing.telemetry_topic = args.telemetry_topic % (thing.thing_name)
+        else:
+            thing.telemetry_topic = args.telemetry_topic
 
-        # Wait for subscriptions to succeed
-        get_accepted_subscribed_future.result()
-        get_rejected_subscribed_future.result()
+    # setup interrupt signals
+    # signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGQUIT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
-        # The response will be received by the on_get_accepted() callback
-        print("[aws] Requesting current shadow state")
-        publish_get_future = shadow_client.publish_get_shadow(
-            request=iotshadow.GetShadowRequest(args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE)
+    # setup AWS connection, shared by all things
+    event_loop_group = io.EventLoopGroup(1)
+    host_resolver = io.DefaultHostResolver(event_loop_group)
+    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
 
-        # Ensure that publish succeeds
-        publish_get_future.result()
+    if args.stats_port:
+        serve_stats(args.stats_port)
 
-    except Exception as e:
-        exit(e)
+    # start sampling while connecting so the first update has data
+    sampler = Sampler([c() for c in COLLECTORS], args.sample_secs)
+    sampler.start()
 
-    publish_count = 1
+    startup = time.time()
+    def start_thing(thing):
+        try:
+            return connect_thing(thing, args, client_bootstrap)
+        except Exception as e:
+            print("[aws] [%s] Failed to subscribe: %s" % (thing.thing_name, e))
+            disconnect(thing)
+            return False
+
+    with ThreadPoolExecutor(max_workers=min(len(things), 8)) as executor:
+        connected = list(executor.map(start_thing, things))
+    # keep serving the things that connected
+    for thing, ok in zip(list(things), connected):
+        if not ok:
+            print("[aws] [%s] Failed all connection attempts, skipping."
+                  % (thing.thing_name))
+            things.remove(thing)
+    if not things:
+        print("[aws] Failed all connection attempts. Restarting.")
+        sys.exit(-1)
+    stats.observe("startup", time.time() - startup)
 
-    # Take initial reading
-    psutil.cpu_percent(percpu=False)
-    locked_data.thing_name = args.thing_name
-    locked_data.before_ts = time.time()
-    locked_data.ioBefore = psutil.net_io_counters()
-    locked_data.diskBefore = psutil.disk_io_counters()
-    psutil.disk_io_counters(perdisk=False, nowrap=True)
+    stats_ts = time.time()
 
     while True:
-        time.sleep(AWS_PUBLISH_DELAY_SECS)
+        now = time.time()
+        if now - stats_ts >= AWS_STATS_SECS:
+            stats_ts = now
+            print("[stats] %s" % (json.dumps(stats.snapshot(), sort_keys=True)))
+
+        with stats.timed("summary"):
+            summary = sampler.summary()
+        for thing in list(things):
+            if thing.error is not None:
+                drop_thing(thing, thing.error)
+                continue
+            update_thing(thing, summary, now, args)
 
-        print("[aws] Updating shadow values [%d]" % (publish_count))
-        data = locked_data.toJSON()
-        request = iotshadow.UpdateShadowRequest(
-            thing_name=args.thing_name,
-            state=iotshadow.ShadowState(
-                reported=data,
-                desired=data,
-            )
-        )
-        future = shadow_client.publish_update_shadow(request, mqtt.QoS.AT_LEAST_ONCE)
-        future.add_done_callback(on_publish_update_shadow)
-
-        publish_count += 1
+        time.sleep(AWS_PUBLISH_DELAY_SECS)
 
 # vim: set tabstop=4 shiftwidth=4 expandtab:
@@ -3,35 +3,44 @@
 AWS_ENDPOINT="ats.iot.us-east-2.amazonaws.com"
 AWS_CERT_LOC="/certs"
 AWS_PROVISION_LOC="/prov"
+AWS_GATEWAY=""
 
-parse_args()
-{
-    while [ $# -gt 0 ]
-    do
-        case $1 in
-        --endpoint)
-            AWS_ENDPOINT=$2
-            shift
-            shift
-            ;;
-        --cert-location)
-            AWS_CERT_LOC=$2
-            shift
-            shift
-            ;;
-        --provision-location)
-            AWS_PROVISION_LOC=$2
-            shift
-            shift
-            ;;
-        *)
-            shift
-            ;;
-        esac
-    done
-}
-
-parse_args "$@"
+# options not handled here are kept in "$@", in order, and passed on to
+# service.py, e.g. --spill-file or --stats-port
+n=$#
+while [ $n -gt 0 ]
+do
+    case $1 in
+    --endpoint)
+        AWS_ENDPOINT=$2
+        shift
+        shift
+        n=$((n - 2))
+        ;;
+    --cert-location)
+        AWS_CERT_LOC=$2
+        shift
+        shift
+        n=$((n - 2))
+        ;;
+    --provision-location)
+        AWS_PROVISION_LOC=$2
+        shift
+        shift
+        n=$((n - 2))
+        ;;
+    --gateway)
+        AWS_GATEWAY=1
+        shift
+        n=$((n - 1))
+        ;;
+    *)
+        set -- "$@" "$1"
+        shift
+        n=$((n - 1))
+        ;;
+    esac
+done
 
 # make sure provisioning dir exists
 if [ ! -d "${AWS_PROVISION_LOC}" ]; then
@@ -39,10 +48,17 @@ if [ ! -d "${AWS_PROVISION_LOC}" ]; then
 	exit 1
 fi
 
+# gateway mode: one thing per provisioned sub-folder of AWS_PROVISION_LOC
+if [ -n "${AWS_GATEWAY}" ]; then
+	exec python3 /service.py --gateway --endpoint "${AWS_ENDPOINT}" \
+		--provision-location "${AWS_PROVISION_LOC}" \
+		--cert-location  "${AWS_CERT_LOC}" "$@"
+fi
+
 if [ ! -e ${AWS_PROVISION_LOC}/device.key ] || [ ! -e ${AWS_PROVISION_LOC}/device.crt ]; then
 	/provision.sh "root" "/certs" "${AWS_PROVISION_LOC}" "${AWS_ENDPOINT}"
 fi
 
 python3 /service.py --thing-name "$(cat ${AWS_PROVISION_LOC}/thing_name)" --endpoint "${AWS_ENDPOINT}" \
 	--provision-location "${AWS_PROVISION_LOC}" \
-	--cert-location  "${AWS_CERT_LOC}"
+	--cert-location  "${AWS_CERT_LOC}" "$@"
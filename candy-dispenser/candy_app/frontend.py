@@ -5,35 +5,78 @@
 # You can find out more about blueprints at
 # http://flask.pocoo.org/docs/blueprints/
 
-from flask import Blueprint, render_template, flash, redirect, url_for, request
+from flask import Blueprint, render_template, flash, redirect, url_for, request, jsonify, session
 from flask_bootstrap import __version__ as FLASK_BOOTSTRAP_VERSION
 from markupsafe import escape
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 import os
+import threading
 import time
 import json
+import uuid
 import requests
 
 frontend = Blueprint('frontend', __name__)
 
 headers = { 'Content-Type': 'application/json'}
 
+# Seconds a resource value read from Leshan is reused before asking again
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 2))
+# Seconds to wait for Leshan, which waits for the device itself
+TIMEOUT = float(os.environ.get('LESHAN_TIMEOUT', 10))
+
+# One pooled session shared by all requests to Leshan
+leshan = requests.Session()
+leshan.headers.update(headers)
+leshan.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=8))
+leshan.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=8))
+
+# url -> (time read, value)
+cache = {}
+cache_lock = threading.Lock()
+
+# Commands run in the background so a button press returns right away;
+# their outcomes are shown to the visitor who sent them on their next page
+# load and on /status/
+executor = ThreadPoolExecutor(max_workers=4)
+# visitor id -> deque of outcomes, for the MAX_VISITORS most recent visitors
+MAX_VISITORS = 100
+outcomes = OrderedDict()
+outcomes_lock = threading.Lock()
+toggle_lock = threading.Lock()
+
 def post(url):
-    response = requests.post(url, headers=headers)
-    if response.status_code == 200 or 201:
-        return True
-    else:
+    try:
+        response = leshan.post(url, timeout=TIMEOUT)
+    except requests.RequestException:
         return False
+    return response.status_code in (200, 201)
 
 def put(url, data):
-    response = requests.put(url, data=json.dumps(data), headers=headers)
+    try:
+        response = leshan.put(url, data=json.dumps(data), timeout=TIMEOUT)
+    except requests.RequestException:
+        return False
     if response.status_code in (200, 201):
+        with cache_lock:
+            cache[url] = (time.time(), data['value'])
         return True
     else:
         return False
 
 def get(url, raw=False):
-    response = requests.get(url, headers=headers)
+    if not raw:
+        with cache_lock:
+            cached = cache.get(url)
+        if cached and time.time() - cached[0] < CACHE_TTL:
+            return cached[1]
+    try:
+        response = leshan.get(url, timeout=TIMEOUT)
+    except requests.RequestException:
+        return None
     if response.status_code in (200, 201):
         try:
             payload = json.loads(response.content)
@@ -44,7 +87,10 @@ def get(url, raw=False):
         else:
             if 'content' in payload:
                 if 'value' in payload['content']:
-                    return payload['content']['value']
+                    value = payload['content']['value']
+                    with cache_lock:
+                        cache[url] = (time.time(), value)
+                    return value
     else:
         return None
 
@@ -52,9 +98,11 @@ def toggle_state():
     host = os.environ['HOST']
     client = os.environ['LIGHT_CLIENT']
     url = '%s/api/clients/%s/3311/0/5850' % (host, client)
-    state = not get(url)
-    nextstate = {'id': 5850, 'value': state}
-    return put(url, nextstate)
+    # one toggle at a time, so two quick presses don't read the same state
+    with toggle_lock:
+        state = not get(url)
+        nextstate = {'id': 5850, 'value': state}
+        return put(url, nextstate)
 
 def trigger():
     host = os.environ['HOST']
@@ -71,30 +119,79 @@ def change_color(color):
     print(color)
     return put(url, {"id": "5706", "value": color})
 
+def visitor():
+    """Return the id of the current visitor, kept in their session."""
+    if 'visitor' not in session:
+        session['visitor'] = uuid.uuid4().hex
+    return session['visitor']
+
+def visitor_outcomes(visitor_id):
+    # call with outcomes_lock held
+    if visitor_id in outcomes:
+        outcomes.move_to_end(visitor_id)
+    else:
+        outcomes[visitor_id] = deque(maxlen=20)
+        if len(outcomes) > MAX_VISITORS:
+            outcomes.popitem(last=False)
+    return outcomes[visitor_id]
+
+def dispatch(name, command, *args):
+    """Run command in the background and record its outcome for the
+    current visitor."""
+    visitor_id = visitor()
+    def run():
+        try:
+            ok = command(*args)
+        except Exception:
+            ok = False
+        outcome = {'command': name, 'ok': ok, 'time': time.time(),
+                   'reported': False}
+        with outcomes_lock:
+            visitor_outcomes(visitor_id).append(outcome)
+    executor.submit(run)
+
+def flash_outcomes():
+    with outcomes_lock:
+        unreported = [o for o in visitor_outcomes(visitor())
+                      if not o['reported']]
+        for outcome in unreported:
+            outcome['reported'] = True
+    for outcome in unreported:
+        if outcome['ok']:
+            flash('%s succeeded' % outcome['command'], 'success')
+        else:
+            flash('%s failed' % outcome['command'], 'danger')
+
 # Our index-page just shows a quick explanation. Check out the template
 # "templates/index.html" documentation for more details.
 @frontend.route('/')
 def index():
+    flash_outcomes()
     return render_template('index.html')
 
+@frontend.route("/status/")
+def status():
+    with outcomes_lock:
+        recent = [dict(o) for o in visitor_outcomes(visitor())]
+    return jsonify(outcomes=recent)
+
 @frontend.route("/dispense/", methods=['POST'])
 def dispense():
     message = "Dispensing Candy..."
-    host = os.environ['HOST']
-    client = os.environ['CANDY_CLIENT']
-    trigger()
+    dispatch('Dispense candy', trigger)
+    flash_outcomes()
     return render_template('index.html', message=message)
 
 @frontend.route("/toggle/", methods=['POST'])
 def light_toggle():
     message = "Toggling Light..."
-    host = os.environ['HOST']
-    client = os.environ['LIGHT_CLIENT']
-    toggle_state()
+    dispatch('Toggle light', toggle_state)
+    flash_outcomes()
     return render_template('index.html', message=message)
 
 
 @frontend.route("/color/", methods=["POST"])
 def color():
-    change_color(request.form.get("color"))
+    dispatch('Change color', change_color, request.form.get("color"))
+    flash_outcomes()
     return render_template("index.html")
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+# Decoder for the batched track messages mqtt-gpsd publishes when
+# GPS_BATCH_SIZE is set.
+#
+# A message is a MessagePack array:
+#
+#   [version, t0, lat0, lon0, [[dt, dlat, dlon, speed, sats], ...]]
+#
+#   version  1
+#   t0       time of the first fix, tenths of a second since the epoch
+#   lat0     latitude of the first fix, millionths of a degree
+#   lon0     longitude of the first fix, millionths of a degree
+#   dt       tenths of a second since the previous fix (0 for the first)
+#   dlat     latitude change since the previous fix, millionths of a degree
+#   dlon     longitude change since the previous fix, millionths of a degree
+#   speed    speed in cm/s
+#   sats     satellites in view
+#
+# Usage:
+#   python3 decode.py <file> ...      decode messages saved to files
+#   mosquitto_sub -t rpi3-02-gps-track -N -C 1 | python3 decode.py
+#
+# Several messages may be concatenated. Without -N mosquitto_sub ends each
+# message with a newline, which is skipped.
+
+import json
+import sys
+import time
+
+import msgpack
+
+
+NEWLINE = 10
+
+
+def messages(stream):
+    """Yield the unpacked track messages read from a binary stream."""
+    for message in msgpack.Unpacker(stream):
+        # a newline between messages unpacks as the integer 10, a track
+        # message is always an array
+        if message == NEWLINE:
+            continue
+        yield message
+
+
+def decode(payload):
+    """Return the fixes in a track message as a list of dicts using the
+    same keys as the per-fix JSON messages.
+    """
+    return decode_message(msgpack.unpackb(payload))
+
+
+def decode_message(message):
+    version, t, lat, lon, records = message
+    if version != 1:
+        raise ValueError('Unsupported track message version: %r' % version)
+    fixes = []
+    for dt, dlat, dlon, speed, sats in records:
+        t += dt
+        lat += dlat
+        lon += dlon
+        fixes.append({
+            'latitude': lat / 1e6,
+            'longitude': lon / 1e6,
+            'speed': speed / 100.0,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t // 10))
+                    + '.%dZ' % (t % 10),
+            'sats': sats,
+        })
+    return fixes
+
+
+if __name__ == '__main__':
+    streams = [open(path, 'rb') for path in sys.argv[1:]]
+    for stream in streams or [sys.stdin.buffer]:
+        with stream:
+            for message in messages(stream):
+                for fix in decode_message(message):
+                    print(json.dumps(fix))
@@ -1,36 +1,299 @@
+# mqtt-gpsd
+import calendar
 import gpsd
-import time
 import json
+import logging
+import math
+import os
+import socket
+import time
+import msgpack
 import paho.mqtt.client as paho
 
-try:
-    gpsd.connect(host="127.0.0.1", port=2947)
-except:
-    print("GPSD failed to connect, exiting...")
-    exit(1)
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    format='[%(asctime)s] [%(levelname)s] %(message)s')
+log = logging.getLogger('mqtt-gpsd')
+
+GPSD_HOST = os.environ.get('GPSD_HOST', '127.0.0.1')
+GPSD_PORT = int(os.environ.get('GPSD_PORT', 2947))
+MQTT_HOST = os.environ.get('MQTT_HOST', '127.0.0.1')
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
+MQTT_TOPIC = os.environ.get('MQTT_TOPIC', 'rpi3-02-gps')
+# Retained fix quality (mode, sats) so consumers can tell "no lock" apart
+# from "no data"
+MQTT_STATUS_TOPIC = os.environ.get('MQTT_STATUS_TOPIC', MQTT_TOPIC + '-status')
+# 'poll' samples gpsd every GPS_POLL_SECS, 'stream' publishes on every fix
+GPS_MODE = os.environ.get('GPS_MODE', 'poll')
+GPS_POLL_SECS = float(os.environ.get('GPS_POLL_SECS', 5))
+# Publish filters: minimum seconds between publishes, minimum movement in
+# meters, and a heartbeat that publishes after GPS_MAX_INTERVAL seconds
+# even when stationary (0 disables each)
+GPS_MIN_INTERVAL = float(os.environ.get('GPS_MIN_INTERVAL', 0))
+GPS_MIN_DISTANCE = float(os.environ.get('GPS_MIN_DISTANCE', 0))
+GPS_MAX_INTERVAL = float(os.environ.get('GPS_MAX_INTERVAL', 0))
+# While waiting for a lock or for gpsd, retry after 1s doubling up to this
+GPS_RETRY_MAX_SECS = float(os.environ.get('GPS_RETRY_MAX_SECS', 10))
+# Minimum seconds between status updates that only change the sats count
+GPS_STATUS_SECS = float(os.environ.get('GPS_STATUS_SECS', 10))
+
+# Batch mode: buffer up to GPS_BATCH_SIZE fixes or GPS_BATCH_SECS seconds
+# and publish them as one compact message on MQTT_BATCH_TOPIC instead of a
+# JSON message per fix (0 disables)
+GPS_BATCH_SIZE = int(os.environ.get('GPS_BATCH_SIZE', 0))
+GPS_BATCH_SECS = float(os.environ.get('GPS_BATCH_SECS', 60))
+MQTT_BATCH_TOPIC = os.environ.get('MQTT_BATCH_TOPIC', MQTT_TOPIC + '-track')
+
+EARTH_RADIUS_M = 6371000.0
+
+# Batch encoding version, see Batch and decode.py
+BATCH_VERSION = 1
+
+# Batch, set in main() when batch mode is enabled
+batch = None
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class Throttle(object):
+    """Decide whether a fix is worth publishing."""
+    def __init__(self, min_interval, min_distance, max_interval):
+        self.min_interval = min_interval
+        self.min_distance = min_distance
+        self.max_interval = max_interval
+        self.last = None
+        self.last_ts = 0
+
+    def accept(self, lat, lon, now):
+        if self.last is not None:
+            elapsed = now - self.last_ts
+            if not (self.max_interval and elapsed >= self.max_interval):
+                if elapsed < self.min_interval:
+                    return False
+                if self.min_distance and \
+                        distance(self.last[0], self.last[1], lat, lon) < \
+                        self.min_distance:
+                    return False
+        self.last = (lat, lon)
+        self.last_ts = now
+        return True
+
+
+class Status(object):
+    """Publish fix quality when the mode changes, or the satellite count
+    changes and GPS_STATUS_SECS have passed.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.mode = None
+        self.sats = None
+        self.last_ts = 0
+
+    def update(self, mode, sats):
+        now = time.time()
+        if mode == self.mode and (sats == self.sats or
+                                  now - self.last_ts < GPS_STATUS_SECS):
+            return
+        if mode != self.mode:
+            log.info('GPS mode %d, %d satellites', mode, sats)
+        self.mode = mode
+        self.sats = sats
+        self.last_ts = now
+        status = {'mode': mode, 'fix': mode >= 2, 'sats': sats}
+        self.client.publish(MQTT_STATUS_TOPIC, payload=json.dumps(status),
+                            qos=0, retain=True)
+
+
+def gps_epoch(value):
+    """Seconds since the epoch for a gpsd ISO 8601 time, or now."""
+    try:
+        whole, _, frac = value.rstrip('Z').partition('.')
+        return (calendar.timegm(time.strptime(whole, '%Y-%m-%dT%H:%M:%S')) +
+                float('0.' + (frac or '0')))
+    except (AttributeError, ValueError):
+        return time.time()
+
+
+class Batch(object):
+    """Buffer fixes and publish them as one MessagePack message.
+
+    The message is [version, t0, lat0, lon0, records] where records is a
+    list of [dt, dlat, dlon, speed, sats]. Times are in tenths of a second
+    since the epoch, coordinates in millionths of a degree (~0.11 m) and
+    speed in cm/s. Each record's time and position are deltas from the
+    previous record, starting from t0/lat0/lon0, so slow movement encodes
+    in a few bytes per fix. decode.py turns a message back into fixes.
+    """
+    def __init__(self, client, size, secs):
+        self.client = client
+        self.size = size
+        self.secs = secs
+        self.fixes = []
+        self.started = 0
+
+    def add(self, fix):
+        if not self.fixes:
+            self.started = time.time()
+        self.fixes.append(fix)
+        self.flush_due()
 
-try:
-    client = paho.Client()
-    client.connect("127.0.0.1", 1883, 60)
-except:
-    print("MQTT broker failed to connect, exiting...")
-    exit(1)
+    def flush_due(self):
+        if self.fixes and (len(self.fixes) >= self.size or
+                           time.time() - self.started >= self.secs):
+            self.flush()
 
-try:
+    def encode(self):
+        records = []
+        prev = None
+        for fix in self.fixes:
+            point = (int(round(gps_epoch(fix['time']) * 10)),
+                     int(round(fix['latitude'] * 1e6)),
+                     int(round(fix['longitude'] * 1e6)))
+            if prev is None:
+                prev = point
+                head = list(point)
+            records.append([point[0] - prev[0], point[1] - prev[1],
+                            point[2] - prev[2],
+                            int(round((fix['speed'] or 0) * 100)),
+                            fix['sats']])
+            prev = point
+        return msgpack.packb([BATCH_VERSION] + head + [records])
+
+    def flush(self):
+        payload = self.encode()
+        self.client.publish(MQTT_BATCH_TOPIC, payload=payload, qos=1)
+        log.debug('%s - %d fixes in %d bytes', MQTT_BATCH_TOPIC,
+                  len(self.fixes), len(payload))
+        self.fixes = []
+
+
+def flush_batch():
+    if batch is not None:
+        batch.flush_due()
+
+
+def backoff(delay):
+    """Sleep for delay and return the next, doubled, retry delay."""
+    time.sleep(delay)
+    return min(delay * 2, GPS_RETRY_MAX_SECS)
+
+
+def publish(client, throttle, mqtt):
+    if not throttle.accept(mqtt['latitude'], mqtt['longitude'], time.time()):
+        return
+    if batch is not None:
+        batch.add(mqtt)
+    else:
+        client.publish(MQTT_TOPIC, payload=json.dumps(mqtt), qos=0,
+                       retain=True)
+        log.debug('%s - %s', MQTT_TOPIC, mqtt)
+
+
+def poll(client, throttle, status):
+    connected = False
+    retry = 1
     while True:
-        mqtt = {}
-        packet = gpsd.get_current()
-        position = packet.position()
-        speed = packet.speed()
+        # a throttled or missing fix must not hold a partial batch back
+        flush_batch()
+        try:
+            if not connected:
+                gpsd.connect(host=GPSD_HOST, port=GPSD_PORT)
+                connected = True
+                log.info('Connected to gpsd at %s:%d', GPSD_HOST, GPSD_PORT)
+            mqtt = {}
+            packet = gpsd.get_current()
+            status.update(packet.mode, packet.sats)
+            position = packet.position()
+            speed = packet.speed()
+        except gpsd.NoFixError:
+            log.debug('No GPS lock, retrying in %.0fs', retry)
+            retry = backoff(retry)
+            continue
+        except Exception as e:
+            connected = False
+            log.warning('gpsd unavailable, retrying in %.0fs: %s', retry, e)
+            retry = backoff(retry)
+            continue
+        retry = 1
         mqtt.update({'latitude': position[0]})
         mqtt.update({'longitude': position[1]})
         mqtt.update({'speed': speed})
         mqtt.update({'time': packet.time})
         mqtt.update({'sats': packet.sats})
-        client.publish("rpi3-02-gps", payload=json.dumps(mqtt), qos=0, retain=True)
-        print(mqtt)
-        time.sleep(5)
-except KeyboardInterrupt:
-    print("Exiting...")
-except:
-    print("No GPS lock, spinning...")
+        publish(client, throttle, mqtt)
+        time.sleep(GPS_POLL_SECS)
+
+
+def watch_reports(host, port):
+    """Yield the JSON reports of a gpsd WATCH stream."""
+    sock = socket.create_connection((host, port))
+    with sock:
+        sock.sendall(b'?WATCH={"enable":true,"json":true};\n')
+        log.info('Watching gpsd at %s:%d', host, port)
+        for line in sock.makefile('r', encoding='utf-8'):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                log.debug('Ignoring malformed gpsd report: %r', line)
+
+
+def stream(client, throttle, status):
+    sats = 0
+    retry = 1
+    while True:
+        try:
+            for report in watch_reports(GPSD_HOST, GPSD_PORT):
+                retry = 1
+                flush_batch()
+                cls = report.get('class')
+                if cls == 'SKY' and 'satellites' in report:
+                    sats = len(report['satellites'])
+                elif cls == 'TPV':
+                    mode = report.get('mode', 0)
+                    status.update(mode, sats)
+                    if mode >= 2 and 'lat' in report:
+                        publish(client, throttle, {
+                            'latitude': report['lat'],
+                            'longitude': report['lon'],
+                            'speed': report.get('speed', 0),
+                            'time': report.get('time', ''),
+                            'sats': sats,
+                        })
+            log.warning('gpsd closed the connection')
+        except OSError as e:
+            log.warning('gpsd unavailable, retrying in %.0fs: %s', retry, e)
+        retry = backoff(retry)
+
+
+def main():
+    global batch
+
+    try:
+        client = paho.Client()
+        client.connect(MQTT_HOST, MQTT_PORT, 60)
+        client.loop_start()
+    except:
+        print("MQTT broker failed to connect, exiting...")
+        exit(1)
+
+    throttle = Throttle(GPS_MIN_INTERVAL, GPS_MIN_DISTANCE, GPS_MAX_INTERVAL)
+    status = Status(client)
+    if GPS_BATCH_SIZE > 0:
+        batch = Batch(client, GPS_BATCH_SIZE, GPS_BATCH_SECS)
+    if GPS_MODE == 'stream':
+        stream(client, throttle, status)
+    else:
+        poll(client, throttle, status)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Exiting...")
@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+
+# End-to-end benchmark for the mqtt-lwm2m bridge.
+#
+# Starts a fake Leshan server and a minimal in-process MQTT broker (or
+# subscribes to an existing broker with --broker), runs run.py against them
+# with a generated subscriptions.yml and reports throughput, notify to
+# publish latency, startup registration time and bridge RSS.
+
+import argparse
+import json
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from fake_leshan import DEFAULT_RESOURCES, FakeLeshan
+
+log = logging.getLogger('bench')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BRIDGE = os.path.join(HERE, '..', 'run.py')
+
+
+class Collector(object):
+    """Record latencies of published notifications."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.messages = 0
+
+    def received(self, payload):
+        now = time.time()
+        try:
+            values = json.loads(payload.decode('utf-8')).values()
+        except ValueError:
+            return
+        with self.lock:
+            self.messages += 1
+            for value in values:
+                if isinstance(value, float):
+                    self.latencies.append(now - value)
+
+    def reset(self):
+        with self.lock:
+            self.latencies = []
+            self.messages = 0
+
+
+class MiniBroker(object):
+    """Just enough of MQTT 3.1.1 to accept publishes from the bridge."""
+    def __init__(self, collector):
+        self.collector = collector
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    @staticmethod
+    def _read(f, n):
+        data = f.read(n)
+        if len(data) != n:
+            raise EOFError()
+        return data
+
+    def _serve(self, conn):
+        f = conn.makefile('rb')
+        try:
+            while True:
+                header = self._read(f, 1)[0]
+                length = shift = 0
+                while True:
+                    byte = self._read(f, 1)[0]
+                    length |= (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = self._read(f, length)
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    conn.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3:  # PUBLISH
+                    qos = (header >> 1) & 3
+                    tlen = struct.unpack('!H', body[:2])[0]
+                    offset = 2 + tlen
+                    if qos:
+                        conn.sendall(b'\x40\x02' + body[offset:offset + 2])
+                        offset += 2
+                    self.collector.received(body[offset:])
+                elif kind == 12:  # PINGREQ
+                    conn.sendall(b'\xd0\x00')
+                elif kind == 14:  # DISCONNECT
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+
+def subscribe_broker(collector, host, port):
+    import paho.mqtt.client as paho
+
+    client = paho.Client()
+    client.on_connect = lambda c, u, f, rc: c.subscribe('#')
+    client.on_message = lambda c, u, msg: collector.received(msg.payload)
+    client.connect(host, port, 60)
+    client.loop_start()
+    return client
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_kb(pid):
+    """Return the RSS of pid plus its direct children (shard workers)."""
+    total = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/status' % entry) as f:
+                status = dict(line.split(':', 1) for line in f)
+        except (OSError, ValueError):
+            continue
+        if int(entry) == pid or int(status.get('PPid', 0)) == pid:
+            total += int(status.get('VmRSS', '0 kB').split()[0])
+    return total
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def make_config(leshan_port, mqtt_host, mqtt_port, resources, extra):
+    config = {
+        'leshan_api': {'url': 'http://127.0.0.1:%d' % leshan_port},
+        'mqtt': {'host': mqtt_host, 'port': mqtt_port,
+                 'log_messages': False},
+        'endpoints': {'default': {
+            'alias': 'bench',
+            'observations': {
+                res: {'type': 'float', 'alias': res.strip('/').replace(
+                    '/', '-')}
+                for res in resources},
+        }},
+    }
+    for section, values in extra.items():
+        if isinstance(values, dict):
+            config.setdefault(section, {}).update(values)
+        else:
+            config[section] = values
+    return config
+
+
+def main(args):
+    collector = Collector()
+    if args.broker:
+        mqtt_host, mqtt_port = args.broker.rsplit(':', 1)
+        mqtt_port = int(mqtt_port)
+        subscribe_broker(collector, mqtt_host, mqtt_port)
+    else:
+        broker = MiniBroker(collector)
+        mqtt_host, mqtt_port = '127.0.0.1', broker.port
+
+    leshan = FakeLeshan(('127.0.0.1', free_port()), args.clients,
+                        args.resources, args.rate, args.stream_duration)
+    leshan.serve()
+
+    extra = yaml.safe_load(args.extra) if args.extra else {}
+    config = make_config(leshan.server_address[1], mqtt_host, mqtt_port,
+                         args.resources, extra)
+    with tempfile.NamedTemporaryFile('w', suffix='.yml',
+                                     delete=False) as f:
+        yaml.safe_dump(config, f)
+    env = dict(os.environ, LOG_LEVEL=args.log_level)
+    start = time.time()
+    bridge = subprocess.Popen([sys.executable, BRIDGE, f.name], env=env)
+    expected = args.clients * len(args.resources)
+    try:
+        while leshan.observations < expected and bridge.poll() is None:
+            if time.time() - start > args.duration:
+                break
+            time.sleep(0.05)
+        registration = (leshan.last_observe or start) - start
+        time.sleep(args.warmup)
+        collector.reset()
+        sent = leshan.notifications
+        measure_start = time.time()
+        peak_rss = 0
+        while time.time() - measure_start < args.duration:
+            if bridge.poll() is not None:
+                break
+            peak_rss = max(peak_rss, rss_kb(bridge.pid))
+            time.sleep(0.5)
+        elapsed = time.time() - measure_start
+        sent = leshan.notifications - sent
+    finally:
+        bridge.terminate()
+        bridge.wait()
+        for path in (f.name, f.name + '.cache'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    with collector.lock:
+        latencies = list(collector.latencies)
+        messages = collector.messages
+    print('clients:            %d x %d resources'
+          % (args.clients, len(args.resources)))
+    print('registration:       %d/%d observations in %.2fs'
+          % (leshan.observations, expected, registration))
+    print('notifications sent: %d (%.0f/s)' % (sent, sent / elapsed))
+    print('mqtt messages:      %d (%.0f/s)' % (messages, messages / elapsed))
+    print('latency p50:        %.1f ms' % (percentile(latencies, 50) * 1000))
+    print('latency p99:        %.1f ms' % (percentile(latencies, 99) * 1000))
+    print('peak rss:           %d kB' % peak_rss)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mqtt-lwm2m benchmark')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=500,
+                        help='NOTIFICATION events per second')
+    parser.add_argument('--resources', nargs='+', default=DEFAULT_RESOURCES)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='measurement time in seconds')
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--stream-duration', type=float, default=0,
+                        help='drop the event stream every N seconds to '
+                             'measure reconnects')
+    parser.add_argument('--broker', metavar='HOST:PORT',
+                        help='use an existing MQTT broker')
+    parser.add_argument('--extra', metavar='YAML',
+                        help='extra subscriptions.yml settings, e.g. '
+                             '"{registration: {workers: 16}}"')
+    parser.add_argument('--log-level', default='WARNING')
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] [%(levelname)s] %(message)s')
+    main(parser.parse_args())
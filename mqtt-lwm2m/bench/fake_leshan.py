@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+# Stand-in for the Leshan REST API and event stream used by run.py.
+#
+# Serves a synthetic client list on /api/clients, accepts observe POSTs
+# and streams NOTIFICATION events on /event at a configurable rate. The
+# notification value is the send timestamp, so a consumer can compute the
+# notify-to-publish latency from the published payload.
+
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+log = logging.getLogger('fake-leshan')
+
+OBSERVE_RE = re.compile(r'^/api/clients/([^/]+)(/[0-9/]+)/observe')
+
+
+class FakeLeshan(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, clients, resources, rate,
+                 stream_duration=0):
+        super().__init__(address, Handler)
+        self.clients = ['bench-%d' % i for i in range(clients)]
+        self.registered = int(time.time() * 1000)
+        self.resources = resources
+        self.rate = rate
+        self.stream_duration = stream_duration
+        self.lock = threading.Lock()
+        self.observations = 0
+        self.first_observe = None
+        self.last_observe = None
+        self.notifications = 0
+
+    def observed(self):
+        now = time.time()
+        with self.lock:
+            self.observations += 1
+            if self.first_observe is None:
+                self.first_observe = now
+            self.last_observe = now
+
+    def notifications_iter(self):
+        """Yield notification events forever, round robin over clients."""
+        while True:
+            for res in self.resources:
+                rid = int(res.rsplit('/', 1)[1])
+                for ep in self.clients:
+                    yield {'ep': ep, 'res': res,
+                           'val': {'id': rid, 'value': time.time()}}
+
+    def serve(self):
+        threading.Thread(target=self.serve_forever, name='fake-leshan',
+                         daemon=True).start()
+        log.info('Fake Leshan on http://%s:%d', *self.server_address)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, code, body=b''):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/api/clients'):
+            reg = self.server.registered
+            body = json.dumps([
+                {'endpoint': ep, 'registrationId': '%s-%d' % (ep, reg),
+                 'registrationDate': reg, 'lastUpdate': reg}
+                for ep in self.server.clients])
+            self._reply(200, body.encode('utf-8'))
+        elif self.path.startswith('/event'):
+            self._stream()
+        else:
+            self._reply(404)
+
+    def do_POST(self):
+        if OBSERVE_RE.match(self.path):
+            self.server.observed()
+            self._reply(200, b'{"status":"CONTENT"}')
+        else:
+            self._reply(404)
+
+    def _stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        events = self.server.notifications_iter()
+        tick = 0.01
+        per_tick = self.server.rate * tick
+        owed = 0.0
+        opened = time.time()
+        duration = self.server.stream_duration
+        try:
+            while not duration or time.time() - opened < duration:
+                start = time.time()
+                owed += per_tick
+                chunk = []
+                while owed >= 1:
+                    chunk.append('event: NOTIFICATION\ndata: %s\n\n'
+                                 % json.dumps(next(events)))
+                    owed -= 1
+                if chunk:
+                    self.wfile.write(''.join(chunk).encode('utf-8'))
+                    self.wfile.flush()
+                    self.server.notifications += len(chunk)
+                time.sleep(max(0, tick - (time.time() - start)))
+        except (BrokenPipeError, ConnectionResetError):
+            log.info('Event stream closed')
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+DEFAULT_RESOURCES = ['/3303/0/5700', '/3311/0/5851']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Leshan server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=100,
+                        help='NOTIFICATION events per second')
+    parser.add_argument('--resources', nargs='+', default=DEFAULT_RESOURCES)
+    parser.add_argument('--stream-duration', type=float, default=0,
+                        help='close event streams after this many seconds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] [%(levelname)s] %(message)s')
+    server = FakeLeshan(('127.0.0.1', args.port), args.clients,
+                        args.resources, args.rate, args.stream_duration)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
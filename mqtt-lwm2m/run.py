@@ -1,119 +1,860 @@
 #!/usr/bin/python3
 
+import hashlib
 import json
 import logging
+import marshal
+import multiprocessing
 import os
+import queue
+import random
+import re
+import signal
+import sqlite3
 import sys
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import yaml
 
 import requests
 import paho.mqtt.client as paho
-from sseclient import SSEClient
+from requests.adapters import HTTPAdapter
+from sseclient import Event, SSEClient, end_of_field
 
 logging.basicConfig(
     level=os.environ.get('LOG_LEVEL', 'INFO'),
     format='[%(asctime)s] [%(levelname)s] %(message)s')
 log = logging.getLogger('leshan-graphite')
 
+class Metrics(object):
+    """Minimal registry rendered in the Prometheus text format."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
-def get_current_endpoints(api_config, endpoints):
-    eplist = []
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * len(self.BUCKETS) + [0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def gauge(self, name, func):
+        """Report the value returned by func() at scrape time."""
+        self.gauges[name] = func
+
+    def render(self):
+        def fmt(name, labels, value):
+            if labels:
+                name += '{%s}' % ','.join('%s="%s"' % l for l in labels)
+            return '%s %s' % (name, value)
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(fmt(name, labels, value))
+            for (name, labels), hist in sorted(self.histograms.items()):
+                for bound, count in zip(self.BUCKETS, hist):
+                    lines.append(fmt(name + '_bucket',
+                                     labels + (('le', bound),), count))
+                lines.append(fmt(name + '_bucket',
+                                 labels + (('le', '+Inf'),), hist[-1]))
+                lines.append(fmt(name + '_sum', labels, hist[-2]))
+                lines.append(fmt(name + '_count', labels, hist[-1]))
+        for name, func in sorted(self.gauges.items()):
+            try:
+                lines.append(fmt(name, (), func()))
+            except Exception:
+                log.exception('Unable to read gauge %s', name)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, address, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug('metrics: ' + format, *args)
+
+        server = HTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics',
+                         daemon=True).start()
+        log.info('Serving metrics on %s:%d/metrics', address, port)
+
+
+metrics = Metrics()
+
+# Shared Leshan REST session and observation Registrar, created in main()
+leshan = None
+registrar = None
+
+# Value converters for the observation 'type' setting, None passes through
+CONVERTERS = {
+    'str': None,
+    'float': float,
+    'int': int,
+}
+
+# endpoint -> registration id of the registration its observations
+# were created for, see registration_id()
+registrations = {}
+
+# (endpoint, resource) -> (topic, key, converter, endpoint topic,
+# Deadband or None), see compile_routes()
+routes = {}
+
+# Deadband value placeholder, None is a valid notification value
+NOTHING = object()
+
+# Log every published notification, set from mqtt.log_messages
+log_messages = True
+
+# Per-endpoint Aggregator and per-key publishing, set from mqtt.aggregate
+aggregator = None
+publish_keys = True
+
+# Endpoint shard handled by this process, see run_sharded()
+shard_index = 0
+shard_count = 1
+
+# Finds the endpoint of an undecoded SSE event for shard routing
+ENDPOINT_RE = re.compile(r'"(?:ep|endpoint)"\s*:\s*"([^"]*)"')
+
+
+class LeshanSession(requests.Session):
+    """Keep-alive session for the Leshan REST API.
+
+    Pool size, timeouts and default headers come from the leshan_api
+    section of subscriptions.yml.
+    """
+    def __init__(self, api_config):
+        super().__init__()
+        pool = api_config.get('pool', {})
+        adapter = HTTPAdapter(pool_connections=pool.get('connections', 1),
+                              pool_maxsize=pool.get('maxsize', 8),
+                              pool_block=pool.get('block', False))
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers.update(api_config.get('headers') or {})
+        if not pool.get('keep_alive', True):
+            self.headers['Connection'] = 'close'
+        timeout = api_config.get('timeout', {})
+        self.timeout = (timeout.get('connect', 5), timeout.get('read', 10))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        try:
+            return super().request(method, url, **kwargs)
+        finally:
+            metrics.observe('lwm2m_leshan_request_seconds',
+                            time.time() - start, method=method)
+
+    def connection_stats(self):
+        """Return counts of new and reused connections across all pools."""
+        new = total = 0
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                new += pool.num_connections
+                total += pool.num_requests
+        return {'new': new, 'reused': total - new}
+
+    def log_stats(self):
+        log.info('Leshan connections: %(new)d new, %(reused)d reused',
+                 self.connection_stats())
+
+
+class Spool(object):
+    """Bounded SQLite store for messages that could not be published.
+
+    Holds at most max_messages, dropping the oldest first, and expires
+    messages older than max_age seconds.
+    """
+    def __init__(self, path, max_messages, max_age):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS spool ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, '
+                        'topic TEXT, payload TEXT, retain INTEGER)')
+        self.depth = self.db.execute(
+            'SELECT COUNT(*) FROM spool').fetchone()[0]
+        self.dropped = 0
+
+    def put(self, topic, payload, retain):
+        with self.lock:
+            self.db.execute('INSERT INTO spool (ts, topic, payload, retain) '
+                            'VALUES (?, ?, ?, ?)',
+                            (time.time(), topic, payload, retain))
+            self.depth += 1
+            if self.depth > self.max_messages:
+                self._delete('id IN (SELECT id FROM spool ORDER BY id '
+                             'LIMIT ?)', self.depth - self.max_messages)
+
+    def expire(self):
+        with self.lock:
+            self._delete('ts < ?', time.time() - self.max_age)
+
+    def peek(self, limit):
+        with self.lock:
+            return self.db.execute('SELECT id, topic, payload, retain '
+                                   'FROM spool ORDER BY id LIMIT ?',
+                                   (limit,)).fetchall()
+
+    def remove(self, last_id):
+        with self.lock:
+            cur = self.db.execute('DELETE FROM spool WHERE id <= ?',
+                                  (last_id,))
+            self.depth -= cur.rowcount
+
+    def _delete(self, where, arg):
+        cur = self.db.execute('DELETE FROM spool WHERE ' + where, (arg,))
+        if cur.rowcount > 0:
+            self.depth -= cur.rowcount
+            self.dropped += cur.rowcount
+            log.debug('Spool full or expired, dropped %d messages',
+                      cur.rowcount)
+
+
+class Publisher(object):
+    """Publish to MQTT, spooling messages while the broker is unreachable.
+
+    Once the broker is back the spool is drained oldest first at
+    drain_rate messages per second. New messages keep going to the spool
+    until it is empty so ordering is preserved.
+    """
+    def __init__(self, client, qos=0, spool=None, drain_rate=0):
+        self.client = client
+        self.qos = qos
+        self.spool = spool
+        self.drain_rate = drain_rate
+        self.drained = 0
+        self.drain_throughput = 0.0
+        self.online = threading.Event()
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        if spool is not None:
+            threading.Thread(target=self._drain, name='spool-drain',
+                             daemon=True).start()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            log.info('MQTT broker connected')
+            self.online.set()
+        else:
+            log.error('MQTT broker refused connection: %d', rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.online.clear()
+        log.warn('MQTT broker disconnected: %d', rc)
+
+    def publish(self, topic, payload=None, retain=False):
+        if self.spool is None:
+            self.client.publish(topic, payload=payload, qos=self.qos,
+                                retain=retain)
+            metrics.inc('lwm2m_mqtt_published_total')
+            return
+        if self.online.is_set() and not self.spool.depth:
+            info = self.client.publish(topic, payload=payload, qos=self.qos,
+                                       retain=retain)
+            if info.rc == paho.MQTT_ERR_SUCCESS:
+                metrics.inc('lwm2m_mqtt_published_total')
+                return
+        self.spool.put(topic, payload, retain)
+        metrics.inc('lwm2m_mqtt_spooled_total')
+
+    def _drain(self):
+        interval = 1.0 / self.drain_rate if self.drain_rate else 0
+        while True:
+            self.online.wait()
+            self.spool.expire()
+            if not self.spool.depth:
+                time.sleep(1)
+                continue
+            start = time.time()
+            sent = 0
+            while self.online.is_set():
+                batch = self.spool.peek(100)
+                if not batch:
+                    break
+                last_id = None
+                for id, topic, payload, retain in batch:
+                    info = self.client.publish(topic, payload=payload,
+                                               qos=self.qos,
+                                               retain=bool(retain))
+                    if info.rc != paho.MQTT_ERR_SUCCESS:
+                        break
+                    last_id = id
+                    sent += 1
+                    metrics.inc('lwm2m_mqtt_published_total')
+                    if interval:
+                        time.sleep(interval)
+                if last_id is None:
+                    break
+                self.spool.remove(last_id)
+            elapsed = time.time() - start
+            self.drained += sent
+            self.drain_throughput = sent / elapsed if elapsed else 0.0
+            log.info('Drained %d spooled messages in %.2fs (%.0f/s), '
+                     '%d left', sent, elapsed, self.drain_throughput,
+                     self.spool.depth)
+            if not sent:
+                time.sleep(1)
+
+
+class Deadband(object):
+    """Per-observation publish filter configured with 'filter:'.
+
+    Drops values equal to the last published one (unchanged) and numeric
+    values within an absolute or percentage deadband of it. Values
+    arriving sooner than min_interval seconds after the last publish are
+    held back, the latest one is published by flush_deadbands() once the
+    interval has passed. Once max_interval seconds have passed the last
+    value is published again, as a heartbeat.
+    """
+    __slots__ = ('lock', 'unchanged', 'absolute', 'percent', 'min_interval',
+                 'max_interval', 'value', 'published', 'pending')
+
+    def __init__(self, config):
+        self.lock = threading.Lock()
+        self.unchanged = config.get('unchanged', False)
+        self.absolute = config.get('deadband', 0)
+        self.percent = config.get('deadband_percent', 0)
+        self.min_interval = config.get('min_interval', 0)
+        self.max_interval = config.get('max_interval', 0)
+        self.value = None
+        self.published = None
+        self.pending = NOTHING
+
+    def accept(self, val, now):
+        with self.lock:
+            last = self.value
+            if self.published is not None and not (
+                    self.max_interval and
+                    now - self.published >= self.max_interval):
+                if self.unchanged and val == last:
+                    self.pending = NOTHING
+                    return False
+                if isinstance(val, (int, float)) and \
+                        isinstance(last, (int, float)):
+                    delta = abs(val - last)
+                    if delta < self.absolute or \
+                            delta < abs(last) * self.percent / 100.0:
+                        self.pending = NOTHING
+                        return False
+                if now - self.published < self.min_interval:
+                    self.pending = val
+                    return False
+            self.value = val
+            self.published = now
+            self.pending = NOTHING
+            return True
+
+    def due(self, now):
+        """Return the value to publish without a new notification, or
+        NOTHING: the one held back once min_interval has passed, or the
+        last one again once max_interval has."""
+        with self.lock:
+            if self.published is None:
+                return NOTHING
+            if self.pending is not NOTHING and \
+                    now - self.published >= self.min_interval:
+                val = self.pending
+            elif self.max_interval and \
+                    now - self.published >= self.max_interval:
+                val = self.value
+            else:
+                return NOTHING
+            self.value = val
+            self.published = now
+            self.pending = NOTHING
+            return val
+
+
+class Aggregator(object):
+    """Coalesce notification values into one document per endpoint.
+
+    Values are merged into the endpoint's last known state and every
+    endpoint that changed during a window is published once, retained, on
+    its endpoint topic.
+    """
+    def __init__(self, client, window):
+        self.client = client
+        self.window = window
+        self.lock = threading.Lock()
+        self.state = {}
+        self.dirty = set()
+        threading.Thread(target=self._run, name='aggregator',
+                         daemon=True).start()
+
+    def add(self, topic, key, val):
+        with self.lock:
+            self.state.setdefault(topic, {})[key] = val
+            self.dirty.add(topic)
+
+    def flush(self):
+        with self.lock:
+            batch = [(topic, json.dumps(self.state[topic]))
+                     for topic in self.dirty]
+            self.dirty = set()
+        for topic, payload in batch:
+            self.client.publish(topic, payload=payload, retain=True)
+            if log_messages:
+                log.info('mqtt: %s - %s', topic, payload)
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Aggregated publish failed')
+
+
+def registration_id(reg):
+    # Older Leshan releases have no registrationId, a new registration
+    # still gets a new registrationDate
+    return reg.get('registrationId', reg.get('registrationDate'))
+
+
+def fetch_clients(api_config):
+    """Return {endpoint: registration id} for all Leshan clients or None."""
     url = api_config['url']
     if not url.endswith('/'):
         url += '/'
     url += 'api/clients'
     try:
-        r = requests.get(url, timeout=0.1)
-    except:
-        log.error('Bad Things Happening!')
-        exit(1)
+        r = leshan.get(url)
+    except requests.RequestException as e:
+        log.error('Unable to get client list: %s - %s', url, e)
+        return None
     if r.status_code != 200:
         log.error('Unable to get client list: %s - %d\n%s',
                   url, r.status_code, r.text)
-        exit(1)
-    else:
-        for client in json.loads(r.content.decode('utf-8')):
-            if 'endpoint' in client:
-                eplist.append(client['endpoint'])
+        return None
+    return {client['endpoint']: registration_id(client)
+            for client in json.loads(r.content.decode('utf-8'))
+            if 'endpoint' in client}
 
-    for endpoint in eplist:
-        if endpoint not in endpoints:
-            config = endpoints['default']
-            endpoints.update({endpoint: config})
 
+def shard_of(epname, shards):
+    # crc32 rather than hash() so every process agrees on the owner
+    return zlib.crc32(epname.encode('utf-8')) % shards
+
+
+def owns(epname):
+    return shard_count == 1 or shard_of(epname, shard_count) == shard_index
+
+
+def track_endpoint(endpoints, epname):
+    """Add a newly seen endpoint to the cache using the default config.
+
+    Endpoints without their own section share the 'default' config object,
+    which is also how untracking tells them apart from configured ones.
+    """
+    ep = endpoints.get(epname)
+    if ep is None and 'default' in endpoints:
+        ep = endpoints[epname] = endpoints['default']
+        compile_routes(epname, ep)
+    return ep
+
+
+def untrack_endpoint(endpoints, epname):
+    ep = endpoints.get(epname)
+    registrations.pop(epname, None)
+    if epname != 'default' and ep is endpoints.get('default'):
+        del endpoints[epname]
+        drop_routes(epname, ep)
+
+
+def compile_routes(epname, config):
+    """Flatten an endpoint's observations into the notification routes."""
+    name = config.get('alias', epname)
+    for res, observation in config.get('observations', {}).items():
+        key = observation.get('alias', res)
+        type = observation.get('type', 'str')
+        if type not in CONVERTERS:
+            log.warn('Invalid observation type: %s', type)
+        topic = epname + '-' + name + '-' + key
+        deadband = observation.get('filter')
+        routes[(epname, res)] = (topic, key, CONVERTERS.get(type),
+                                 epname + '-' + name,
+                                 Deadband(deadband) if deadband else None)
+
+
+def drop_routes(epname, config):
+    for res in config.get('observations', {}):
+        routes.pop((epname, res), None)
+
+
+def get_current_endpoints(api_config, endpoints):
+    clients = fetch_clients(api_config)
+    if clients is None:
+        exit(1)
+    for endpoint, regid in clients.items():
+        if owns(endpoint) and track_endpoint(endpoints, endpoint):
+            registrations[endpoint] = regid
     return endpoints
 
-def sseclient_from_config(subscriptions):
+
+def apply_clients(endpoints, clients):
+    """Reconcile the endpoint cache with a full Leshan client list.
+
+    Returns the endpoints that need observations: those missing from the
+    cache and those that registered again since they were observed, which
+    drops their observations on the server.
+    """
+    for epname in list(endpoints):
+        if epname != 'default' and epname not in clients:
+            untrack_endpoint(endpoints, epname)
+    changed = {}
+    for epname, regid in clients.items():
+        if registrations.get(epname) != regid:
+            ep = track_endpoint(endpoints, epname)
+            if ep:
+                registrations[epname] = regid
+                changed[epname] = ep
+    log.info('Endpoint resync: %d live, %d new or re-registered',
+             len(clients), len(changed))
+    return changed
+
+
+class StreamSSEClient(SSEClient):
+    """SSEClient that stops iterating when the stream drops.
+
+    SSEClient sleeps for a fixed retry delay and reconnects on its own;
+    this leaves reconnecting, backoff and Last-Event-ID to sse_intake().
+    """
+    def __next__(self):
+        while not self._event_complete():
+            # StopIteration at the end of the stream ends the iteration,
+            # read errors propagate
+            self.buf += self.decoder.decode(next(self.resp_iterator))
+        event_string, self.buf = end_of_field.split(self.buf, maxsplit=1)
+        msg = Event.parse(event_string)
+        if msg.id:
+            self.last_id = msg.id
+        return msg
+
+
+def sseclient_from_config(subscriptions, last_id=None):
     api = subscriptions['leshan_api']
     url = api['url']
     if not url.endswith('/'):
         url += '/'
     url += 'event'
-    try:
-        return SSEClient(url, allow_redirects=api.get('allow_redirects'))
-    except:
-        exit(1)
+    # Without a read timeout a half-open connection blocks the reader
+    # forever and the stream is never reconnected.
+    sse_config = subscriptions.get('sse', {})
+    timeout = (sse_config.get('connect_timeout', 10),
+               sse_config.get('read_timeout', 300))
+    return StreamSSEClient(url, last_id=last_id,
+                           allow_redirects=api.get('allow_redirects'),
+                           timeout=timeout)
+
+
+def observation_paths(config):
+    """Return the LwM2M paths to observe for an endpoint config.
+
+    With 'observe: instance' the configured resources are grouped so each
+    object instance (e.g. /3/0) is observed once instead of per resource.
+    """
+    paths = config.get('observations', {}).keys()
+    if config.get('observe') != 'instance':
+        return list(paths)
+    return sorted({p.rsplit('/', 1)[0] if p.count('/') == 3 else p
+                   for p in paths})
+
 
+def create_observations(api_config, endpoint, config, retries=0,
+                        retry_delay=1):
+    """Register every configured observation for an endpoint.
 
-def create_observations(api_config, endpoint, config):
-    if endpoint != 'default':
-        for ipso in config.get('observations', {}).keys():
-            url = api_config['url']
-            if not url.endswith('/'):
-                url += '/'
-            url += 'api/clients/%s%s/observe?format=TLV' % (endpoint, ipso)
+    Returns a (succeeded, failed) tuple of observation counts.
+    """
+    ok = failed = 0
+    if endpoint == 'default':
+        return ok, failed
+    name = config.get('alias', endpoint)
+    for ipso in observation_paths(config):
+        url = api_config['url']
+        if not url.endswith('/'):
+            url += '/'
+        url += 'api/clients/%s%s/observe?format=TLV' % (endpoint, ipso)
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(retry_delay * attempt)
             try:
-                r = requests.post(url, headers=api_config.get('headers'), timeout=10)
-            except:
-                log.error('Bad Things Happening!')
-                exit(1)
-            if r.status_code != 200:
-                log.error('Unable to register observation: %s - %d\n%s',
-                          url, r.status_code, r.text)
+                r = leshan.post(url)
+            except requests.RequestException as e:
+                log.error('%s - observation request failed: %s - %s',
+                          name, url, e)
+                continue
+            if r.status_code < 500:
+                break
+            log.error('%s - observation attempt %d failed: %s - %d',
+                      name, attempt + 1, url, r.status_code)
+        else:
+            failed += 1
+            metrics.inc('lwm2m_observation_failures_total')
+            continue
+        if r.status_code != 200:
+            log.error('Unable to register observation: %s - %d\n%s',
+                      url, r.status_code, r.text)
+            failed += 1
+            metrics.inc('lwm2m_observation_failures_total')
+        else:
+            log.info('%s - created observation for: %s', name, ipso)
+            ok += 1
+            metrics.inc('lwm2m_observations_created_total')
+    return ok, failed
+
+
+class Registrar(object):
+    """Create observations on a bounded thread pool.
+
+    Keeps slow Leshan observe requests off the event processing thread.
+    """
+    def __init__(self, api_config, reg_config):
+        self.api_config = api_config
+        self.workers = reg_config.get('workers', 8)
+        self.retries = reg_config.get('retries', 2)
+        self.retry_delay = reg_config.get('retry_delay', 1)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    def submit(self, endpoint, config):
+        future = self.pool.submit(create_observations, self.api_config,
+                                  endpoint, config, self.retries,
+                                  self.retry_delay)
+        def done(future):
+            if future.exception() is not None:
+                log.error('%s - observation registration crashed: %s',
+                          endpoint, future.exception())
+        future.add_done_callback(done)
+        return future
+
+    def register_all(self, endpoints):
+        """Register all endpoints and log a summary once they complete."""
+        start = time.time()
+        ok = failed = 0
+        futures = {self.submit(endpoint, config): endpoint
+                   for endpoint, config in endpoints.items()
+                   if endpoint != 'default'}
+        for future in as_completed(futures):
+            if future.exception() is None:
+                ep_ok, ep_failed = future.result()
+                ok += ep_ok
+                failed += ep_failed
+        log.info('Registered %d observations for %d endpoints in %.2fs '
+                 '(%d failed, %d workers)', ok, len(futures),
+                 time.time() - start, failed, self.workers)
+        leshan.log_stats()
+        return ok, failed
+
+    def resync(self, events):
+        """Fetch the client list and queue it as a RESYNC event."""
+        def fetch():
+            clients = fetch_clients(self.api_config)
+            if clients is None:
+                log.warn('Endpoint resync failed, keeping cached endpoints')
             else:
-                name = config.get('alias', endpoint)
-                log.info('%s - created observation for: %s', name, ipso)
+                events.put(('RESYNC', clients, time.time()))
+        self.pool.submit(fetch)
+
+
+def sse_intake(subscriptions, dispatch):
+    """Hand SSE events to dispatch() as (kind, data, arrival time) items.
+
+    The event data is passed on undecoded. dispatch() blocks when the
+    processing queue is full so a backlog pushes back on the SSE stream
+    rather than growing without bound. Lost connections are retried with
+    jittered exponential backoff, resuming from the last event id, and
+    announced with a RECONNECTED item.
+    """
+    sse_config = subscriptions.get('sse', {})
+    delay = sse_config.get('reconnect_delay', 1)
+    max_delay = sse_config.get('reconnect_max_delay', 60)
+    last_id = None
+    connected = False
+    failures = 0
+    try:
+        while True:
+            try:
+                sse = sseclient_from_config(subscriptions, last_id)
+                if connected:
+                    log.info('SSE stream reconnected')
+                    dispatch(('RECONNECTED', None, time.time()))
+                connected = True
+                for event in sse:
+                    failures = 0
+                    last_id = sse.last_id
+                    if event.event:
+                        metrics.inc('lwm2m_sse_events_total',
+                                    type=event.event)
+                        dispatch((event.event, event.data, time.time()))
+                log.warn('SSE stream ended')
+            except Exception as e:
+                log.error('SSE stream failed: %s', e)
+            failures += 1
+            wait = min(max_delay, delay * 2 ** (failures - 1))
+            wait = random.uniform(wait / 2, wait)
+            metrics.inc('lwm2m_sse_reconnects_total')
+            log.info('Reconnecting to SSE stream in %.1fs', wait)
+            time.sleep(wait)
+    finally:
+        dispatch(None)
+
+
+def enqueue(events, item):
+    while True:
+        try:
+            events.put(item, timeout=5)
+            return
+        except queue.Full:
+            log.warn('Event queue full, processing is falling behind')
+
+
+def decode_values(res, val):
+    """Yield (resource path, value) pairs from a notification value.
+
+    Handles the JSON nodes Leshan relays for TLV content (single and
+    multi-instance resources, object instances and objects) as well as
+    SenML JSON record lists.
+    """
+    if isinstance(val, list):
+        base = ''
+        for record in val:
+            base = record.get('bn', base)
+            for field in ('v', 'vs', 'vb', 'vd'):
+                if field in record:
+                    path = (base + record.get('n', '')).rstrip('/')
+                    yield path, record[field]
+                    break
+    elif 'value' in val:
+        yield res, val['value']
+    elif 'values' in val:
+        yield res, val['values']
+    elif 'resources' in val:
+        for resource in val['resources']:
+            for item in decode_values('%s/%d' % (res, resource['id']),
+                                      resource):
+                yield item
+    elif 'instances' in val:
+        for instance in val['instances']:
+            for item in decode_values('%s/%d' % (res, instance['id']),
+                                      instance):
+                yield item
+
+
+def publish_value(client, route, val):
+    convert, deadband = route[2], route[4]
+    if convert is not None:
+        val = convert(val)
+    if deadband is not None and not deadband.accept(val, time.time()):
+        metrics.inc('lwm2m_notifications_suppressed_total')
+        return
+    emit_value(client, route, val)
+
+
+def emit_value(client, route, val):
+    topic, key, convert, ep_topic, deadband = route
+    if aggregator is not None:
+        aggregator.add(ep_topic, key, val)
+    if publish_keys:
+        payload = json.dumps({key: val})
+        client.publish(topic, payload=payload, retain=True)
+        if log_messages:
+            log.info('mqtt: %s - %s', topic, payload)
+
+
+def flush_deadbands(client):
+    """Publish the values filters held back by min_interval and the
+    max_interval heartbeats, checked every second."""
+    while True:
+        time.sleep(1)
+        now = time.time()
+        for route in list(routes.values()):
+            deadband = route[4]
+            if deadband is None:
+                continue
+            try:
+                val = deadband.due(now)
+                if val is not NOTHING:
+                    emit_value(client, route, val)
+                    metrics.inc('lwm2m_notifications_deferred_total')
+            except Exception:
+                log.exception('Deferred publish failed: %s', route[0])
 
 
 def on_notify(api_config, endpoints, client, event):
     epname = event['ep']
-    ep = endpoints.get(epname)
-    if ep:
-        observation = ep.get('observations', {}).get(event['res'])
-        if not observation:
-            log.warn('%s got an unconfigured observation for: %s',
-                     epname, event['res'])
+    res = event['res'].rstrip('/')
+    val = event['val']
+    if isinstance(val, dict) and 'value' in val:
+        route = routes.get((epname, res))
+        if route is None:
+            if epname in endpoints:
+                log.warn('%s got an unconfigured observation for: %s',
+                         epname, res)
             return
-        name = ep.get('alias', epname)
-        key = observation.get('alias', event['res'])
-        val = event['val']['value']
-        type = observation.get('type', 'str')
-        if type == 'str':
-            pass
-        elif type == 'float':
-            val = float(val)
-        elif type == 'int':
-            val = int(val)
-        else:
-            log.warn('Invalid observation type: %s', type)
-        log.info('%s - observed %s = %s', name, key, val)
-        mqtt = {}
-        mqtt.update({key: val})
-        topic = epname + '-' + name + '-' + key
-        client.publish(topic, payload=json.dumps(mqtt), qos=0, retain=True)
-        log.info('mqtt: %s - %s', topic, mqtt)
+        publish_value(client, route, val['value'])
+        return
+    # Instance/object observations carry every resource, unconfigured
+    # ones are expected and skipped quietly
+    for path, value in decode_values(res, val):
+        route = routes.get((epname, path))
+        if route is not None:
+            publish_value(client, route, value)
 
 
 def on_updated(api_config, endpoints, client, event):
-    endpoints = get_current_endpoints(api_config, endpoints)
-    epname = event['endpoint']
-    ep = endpoints.get(epname)
+    # UPDATED events may wrap the registration alongside the update itself
+    reg = event.get('registration', event)
+    epname = reg['endpoint']
+    ep = track_endpoint(endpoints, epname)
     if ep:
         name = ep.get('alias', epname)
-        if event['registrationDate'] == event['lastUpdate']:
+        if reg['registrationDate'] == reg['lastUpdate']:
             log.info('%s - connected', name)
-            create_observations(api_config, epname, ep)
+            registrations[epname] = registration_id(reg)
+            registrar.submit(epname, ep)
         else:
             log.debug('%s - updated', name)
 
@@ -123,46 +864,267 @@ def on_deregistration(api_config, endpoints, client, event):
     ep = endpoints.get(epname)
     if ep:
         log.warn('%s - disconnected', ep.get('alias', epname))
+        untrack_endpoint(endpoints, epname)
 
 
-def main(subscriptions):
+def on_resync(api_config, endpoints, client, clients):
+    clients = {epname: regid for epname, regid in clients.items()
+               if owns(epname)}
+    for epname, config in apply_clients(endpoints, clients).items():
+        registrar.submit(epname, config)
+
+
+def run_bridge(subscriptions, events=None):
+    """Run the bridge on one event queue.
+
+    Without events an SSE intake thread is started to feed the queue,
+    shard workers get theirs from the run_sharded() intake process.
+    """
+    global leshan, registrar, log_messages, aggregator, publish_keys
+
     handlers = {
         'NOTIFICATION': on_notify,
         'UPDATED': on_updated,
         'REGISTRATION': on_updated,
         'DEREGISTRATION': on_deregistration,
+        'RESYNC': on_resync,
     }
     api_config = subscriptions['leshan_api']
     endpoints = subscriptions['endpoints']
     mqtt = subscriptions['mqtt']
     log.info('Initialization Started')
+    leshan = LeshanSession(api_config)
+    log_messages = mqtt.get('log_messages', True)
+    for epname, config in endpoints.items():
+        if epname != 'default' and owns(epname):
+            compile_routes(epname, config)
+    spool_config = mqtt.get('spool', {})
+    spool = None
+    if spool_config.get('enabled'):
+        spool = Spool(spool_config.get('path', 'spool.db'),
+                      spool_config.get('max_messages', 100000),
+                      spool_config.get('max_age', 86400))
+        log.info('Spooling offline messages to %s (%d queued)',
+                 spool_config.get('path', 'spool.db'), spool.depth)
     try:
-        client = paho.Client()
-        client.connect(mqtt['host'], mqtt['port'], 60)
-        client.loop_start()
+        mqtt_client = paho.Client()
+        client = Publisher(mqtt_client, mqtt.get('qos', 0), spool,
+                           spool_config.get('drain_rate', 500))
+        if spool is not None:
+            # paho keeps retrying in its network thread; messages are
+            # spooled until the broker is reachable
+            mqtt_client.connect_async(mqtt['host'], mqtt['port'], 60)
+        else:
+            mqtt_client.connect(mqtt['host'], mqtt['port'], 60)
+        mqtt_client.loop_start()
         log.info('MQTT Client Started')
     except:
         print("MQTT broker failed to connect, exiting...")
         exit(1)
 
+    aggregate = mqtt.get('aggregate', {})
+    if aggregate.get('enabled'):
+        aggregator = Aggregator(client, aggregate.get('window', 0.5))
+        publish_keys = aggregate.get('per_key', True)
+        log.info('Aggregating notifications every %ss', aggregator.window)
+    threading.Thread(target=flush_deadbands, args=(client,),
+                     name='deadband', daemon=True).start()
+
+    reg_config = subscriptions.get('registration', {})
+    resync_interval = reg_config.get('resync_interval', 0)
+    registrar = Registrar(api_config, reg_config)
     endpoints = get_current_endpoints(api_config, endpoints)
-    for endpoint, config in endpoints.items():
-        create_observations(api_config, endpoint, config)
-    log.info('Initial Observations Registered')
+    owned = {epname: config for epname, config in endpoints.items()
+             if owns(epname)}
+    threading.Thread(target=registrar.register_all, args=(owned,),
+                     name='startup-registration', daemon=True).start()
 
-    for event in sseclient_from_config(subscriptions):
-        cb = handlers.get(event.event)
-        if cb:
-            cb(api_config, endpoints, client, json.loads(event.data))
+    intake = events is None
+    if intake:
+        events = queue.Queue(
+            subscriptions.get('sse', {}).get('queue_size', 1000))
+
+    metrics.gauge('lwm2m_endpoints',
+                  lambda: len(endpoints) - ('default' in endpoints))
+    metrics.gauge('lwm2m_event_queue_depth', events.qsize)
+    if spool is not None:
+        metrics.gauge('lwm2m_spool_depth', lambda: spool.depth)
+        metrics.gauge('lwm2m_spool_dropped', lambda: spool.dropped)
+        metrics.gauge('lwm2m_spool_drain_per_second',
+                      lambda: client.drain_throughput)
+    metrics_config = subscriptions.get('metrics', {})
+    if metrics_config.get('enabled'):
+        metrics.serve(metrics_config.get('address', '0.0.0.0'),
+                      metrics_config.get('port', 9100))
+    if intake:
+        threading.Thread(target=sse_intake,
+                         args=(subscriptions,
+                               lambda item: enqueue(events, item)),
+                         name='sse-intake', daemon=True).start()
     log.info('Server Side Callbacks Registered')
 
+    last_resync = time.time()
+    while True:
+        item = events.get()
+        if item is None:
+            break
+        kind, data, received = item
+        if isinstance(data, str):
+            data = json.loads(data)
+        if kind == 'RECONNECTED' or (
+                resync_interval and
+                time.time() - last_resync >= resync_interval):
+            last_resync = time.time()
+            registrar.resync(events)
+        cb = handlers.get(kind)
+        if cb:
+            try:
+                cb(api_config, endpoints, client, data)
+            except Exception:
+                log.exception('%s handler failed', kind)
+            if kind == 'NOTIFICATION':
+                metrics.observe('lwm2m_notify_latency_seconds',
+                                time.time() - received)
+
+
+def run_worker(subscriptions, events, index, shards):
+    global shard_index, shard_count
+
+    shard_index, shard_count = index, shards
+    log.info('Shard %d/%d started', index + 1, shards)
+    # Each shard gets its own metrics port and spool file
+    metrics_config = subscriptions.setdefault('metrics', {})
+    metrics_config['port'] = metrics_config.get('port', 9100) + 1 + index
+    spool_config = subscriptions['mqtt'].get('spool')
+    if spool_config:
+        spool_config['path'] = '%s.%d' % (
+            spool_config.get('path', 'spool.db'), index)
+    try:
+        run_bridge(subscriptions, events)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_sharded(subscriptions, shards):
+    """Split endpoints across shard worker processes.
+
+    This process only reads the SSE stream and routes each undecoded event
+    to the worker owning its endpoint, which decodes and handles it with
+    its own MQTT connection and observation registrations.
+    """
+    size = subscriptions.get('sse', {}).get('queue_size', 1000)
+    queues = [multiprocessing.Queue(size) for _ in range(shards)]
+    workers = []
+    for index, events in enumerate(queues):
+        worker = multiprocessing.Process(
+            target=run_worker, args=(subscriptions, events, index, shards),
+            name='shard-%d' % index, daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    def dispatch(item):
+        match = ENDPOINT_RE.search(item[1]) if item and item[1] else None
+        if match:
+            enqueue(queues[shard_of(match.group(1), shards)], item)
+        else:
+            for events in queues:
+                enqueue(events, item)
+
+    metrics_config = subscriptions.get('metrics', {})
+    if metrics_config.get('enabled'):
+        metrics.serve(metrics_config.get('address', '0.0.0.0'),
+                      metrics_config.get('port', 9100))
+    threading.Thread(target=sse_intake, args=(subscriptions, dispatch),
+                     name='sse-intake', daemon=True).start()
+    log.info('Routing events to %d shards', shards)
+
+    while all(worker.is_alive() for worker in workers):
+        time.sleep(1)
+    for worker in workers:
+        if worker.exitcode:
+            log.error('%s exited with %d', worker.name, worker.exitcode)
+            exit(1)
+
+
+def config_key(config):
+    try:
+        return json.dumps(config, sort_keys=True)
+    except TypeError:
+        # e.g. a YAML timestamp, such sections are left unshared
+        return None
+
+
+def share_endpoint_configs(endpoints):
+    """Make identical endpoint sections, e.g. copies of 'default', one
+    shared object instead of a copy per endpoint.
+    """
+    shared = {}
+    default = endpoints.get('default')
+    if default is not None:
+        shared[config_key(default)] = default
+    for epname, config in endpoints.items():
+        key = config_key(config)
+        if key is not None:
+            endpoints[epname] = shared.setdefault(key, config)
+
+
+def load_config(path):
+    """Load subscriptions.yml, reusing a cached copy while it is unchanged.
+
+    The cache lives next to the file (or at $CONFIG_CACHE) and is keyed by
+    the SHA-1 of the file contents. It is written with marshal, which only
+    stores data, so a tampered cache cannot run code the way a pickle
+    could. libyaml's C loader is used to parse when PyYAML was built with
+    it.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    cache = os.environ.get('CONFIG_CACHE', path + '.cache')
+    try:
+        with open(cache, 'rb') as f:
+            cached_digest, subscriptions = marshal.load(f)
+        if cached_digest == digest and isinstance(subscriptions, dict):
+            log.debug('Loaded config from cache %s', cache)
+            share_endpoint_configs(subscriptions.get('endpoints', {}))
+            return subscriptions
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    subscriptions = yaml.load(data, Loader=loader)
+    share_endpoint_configs(subscriptions.get('endpoints', {}))
+    try:
+        tmp = '%s.%d' % (cache, os.getpid())
+        with open(tmp, 'wb') as f:
+            marshal.dump((digest, subscriptions), f)
+        os.replace(tmp, cache)
+    except (OSError, ValueError) as e:
+        log.debug('Unable to write config cache %s: %s', cache, e)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return subscriptions
+
+
+def main(subscriptions):
+    shards = subscriptions.get('shards', 1)
+    if shards > 1:
+        run_sharded(subscriptions, shards)
+    else:
+        run_bridge(subscriptions)
+
 
 if __name__ == '__main__':
     if len(sys.argv) != 2:
         sys.exit('Usage: %s <path to subscriptions.yml>' % sys.argv[0])
 
-    with open(sys.argv[1]) as f:
-        subscriptions = yaml.load(f)
+    subscriptions = load_config(sys.argv[1])
     try:
         main(subscriptions)
     except KeyboardInterrupt: